@@ -0,0 +1,227 @@
+"""
+Stage-by-stage benchmark of the extraction pipelines on synthetic inputs.
+
+Generates keyboard/mouse captures and mice logs of the given sizes, times
+input hashing, extraction, decoding, text rebuild and rendering separately,
+records the peak memory of each stage (tracemalloc, in a second run so the
+timings are not slowed down by tracing) and checks the decoded results
+against the generated data and the sample files.
+
+    python benchmarks/bench_pipeline.py [-n 1000 -n 1000000] [--devices 4] [--format pcapng] [--json out.json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, NamedTuple, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+"""
+Repository root
+"""
+
+sys.path.insert(0, ROOT)
+
+import synthetic
+from extensions import set_level
+from extensions.utils import file_sha1, file_fingerprint
+from extensions.usbutils import get_hiddata_mapping
+from extensions.keyboard import keypress_from_hiddata, content_from_keypress
+from extensions.mice import micemsg_from_hiddata, handle_micemsgs, heatmap_micemsgs, MICE_COLORS, MICE_ALPHAS
+from extensions.micelog import micemsg_from_micelog_file
+
+KINDS = ('keyboard', 'mice', 'micelog')
+"""
+Benchmarked pipelines
+"""
+
+FIXTURES = {
+    os.path.join('keyboard_test', 'example.pcap'): ('keyboard', {'2.1.1': 'flag{pr355_0nwards_a2fee6e0}'}),
+    os.path.join('keyboard_test', 'usb.pcapng'): ('keyboard', {'1.1.1': 'zip -e -P cXNken15ZHMh goddess.zip goddess.png\n'}),
+    os.path.join('mice_test', 'data.pcap'): ('mice', {'2.2.1': (72, 791, 0), '2.3.1': (8949, 957, -625)}),
+    os.path.join('micelog_test', 'micelog'): ('micelog', {'micelog': (2741, -275, 248)}),
+}
+"""
+Sample files and their expected results: typed text per device, or (points, last x, last y) per trajectory
+"""
+
+POSITION = ('move', 'left', 'right')
+"""
+Statuses drawn when rendering
+"""
+
+class Stage(NamedTuple):
+    kind: str
+    size: int
+    name: str
+    seconds: float
+    peak: Optional[int]
+
+class Pipeline:
+    """
+    Runs the stages of one input one after another, each stage consuming the previous results
+    """
+
+    def __init__(self, kind: str, size: int, memory: bool):
+        self.kind = kind
+        self.size = size
+        self.memory = memory
+        self.stages: list[Stage] = []
+
+    def stage(self, name: str, func: Callable, *args):
+        """
+        Time `func(*args)`, then run it again under tracemalloc for its peak memory
+
+        Returns:
+            The result of the first call
+        """
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        peak = None
+        if self.memory:
+            tracemalloc.start()
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.stages.append(Stage(self.kind, self.size, name, seconds, peak))
+        return result
+
+def trajectory_summary(trajectory):
+    return len(trajectory), int(trajectory.x[-1]), int(trajectory.y[-1])
+
+def save_figures(figures: list, outdir: str, suffix: str):
+    for i, (fig, ax) in enumerate(figures):
+        if ax.has_data():
+            fig.savefig(os.path.join(outdir, f'{i}{suffix}.png'))
+
+def render(trajectories: dict, colors: tuple, alphas: tuple, outdir: str):
+    save_figures([handle_micemsgs(micemsgs, POSITION, colors, alphas) for micemsgs in trajectories.values()], outdir, '')
+
+def render_heatmap(trajectories: dict, outdir: str):
+    save_figures([heatmap_micemsgs(micemsgs, POSITION) for micemsgs in trajectories.values()], outdir, '-heatmap')
+
+def run_keyboard(pipeline: Pipeline, filepath: str, rendering: bool, outdir: str):
+    pipeline.stage('hash', file_sha1, filepath)
+    pipeline.stage('fingerprint', file_fingerprint, filepath)
+    hiddata_mapping = pipeline.stage('extraction', get_hiddata_mapping, filepath)
+    pressed_keys = pipeline.stage('decoding', lambda: {device_id: keypress_from_hiddata(hiddatas)
+                                                       for device_id, hiddatas in hiddata_mapping.items()})
+    return pipeline.stage('text rebuild', lambda: {device_id: ''.join(content_from_keypress(keys))
+                                                   for device_id, keys in pressed_keys.items()})
+
+def run_mice(pipeline: Pipeline, filepath: str, rendering: bool, outdir: str):
+    pipeline.stage('hash', file_sha1, filepath)
+    pipeline.stage('fingerprint', file_fingerprint, filepath)
+    hiddata_mapping = pipeline.stage('extraction', get_hiddata_mapping, filepath)
+    trajectories = pipeline.stage('decoding', lambda: {device_id: micemsg_from_hiddata(hiddatas)
+                                                       for device_id, hiddatas in hiddata_mapping.items()})
+    if rendering:
+        pipeline.stage('rendering', render, trajectories, MICE_COLORS, MICE_ALPHAS, outdir)
+        pipeline.stage('heatmap', render_heatmap, trajectories, outdir)
+    return {device_id: trajectory_summary(micemsgs) for device_id, micemsgs in trajectories.items()}
+
+def run_micelog(pipeline: Pipeline, filepath: str, rendering: bool, outdir: str):
+    pipeline.stage('hash', file_sha1, filepath)
+    pipeline.stage('fingerprint', file_fingerprint, filepath)
+    trajectories = {'micelog': pipeline.stage('decoding', micemsg_from_micelog_file, filepath)}
+    if rendering:
+        pipeline.stage('rendering', render, trajectories, MICE_COLORS, MICE_ALPHAS, outdir)
+        pipeline.stage('heatmap', render_heatmap, trajectories, outdir)
+    return {device_id: trajectory_summary(micemsgs) for device_id, micemsgs in trajectories.items()}
+
+RUNNERS = {
+    'keyboard': run_keyboard,
+    'mice': run_mice,
+    'micelog': run_micelog,
+}
+"""
+Pipeline of each kind, returning a comparable result
+"""
+
+def generate(kind: str, size: int, options: argparse.Namespace, outdir: str):
+    """
+    Write a synthetic input of `size` reports
+
+    Returns:
+        (file path, expected result)
+    """
+    devices = options.devices
+    device_ids = [f'1.{device + 1}.1' for device in range(devices)]
+    if kind == 'micelog':
+        filepath = os.path.join(outdir, f'micelog-{size}')
+        packets = synthetic.micelog_packets(size)
+        synthetic.write_micelog(filepath, packets)
+        offsets = packets[:, 1:3].view('i1').sum(axis=0, dtype='i8')
+        return filepath, {'micelog': (size + 1, int(offsets[0]), int(offsets[1]))}
+    filepath = os.path.join(outdir, f'{kind}-{size}.{options.format}')
+    if kind == 'keyboard':
+        reports, text = synthetic.keyboard_reports(size // devices)
+        expected = dict.fromkeys(device_ids, text)
+    else:
+        reports = synthetic.mouse_reports(size // devices)
+        offsets = reports[:, 1:3].view('i1').sum(axis=0, dtype='i8')
+        expected = dict.fromkeys(device_ids, (len(reports) + 1, int(offsets[0]), -int(offsets[1])))
+    synthetic.write_capture(filepath, synthetic.interleave(reports, devices), devices,
+                            synthetic.LINKTYPES[options.linktype], options.format == 'pcapng')
+    return filepath, expected
+
+def check_fixtures():
+    """
+    Run every pipeline on the sample files
+
+    Returns:
+        Number of mismatches
+    """
+    failures = 0
+    with tempfile.TemporaryDirectory() as outdir:
+        for path, (kind, expected) in FIXTURES.items():
+            result = RUNNERS[kind](Pipeline(kind, 0, False), os.path.join(ROOT, path), False, outdir)
+            matched = all(result.get(key) == value for key, value in expected.items())
+            print(f'fixture  {path:32s} {"ok" if matched else "MISMATCH"}')
+            failures += not matched
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--size', type=int, action='append', help='reports per input, repeatable (default: 1000 and 100000)')
+    parser.add_argument('-k', '--kind', choices=KINDS, action='append', help='pipelines to run, repeatable (default: all)')
+    parser.add_argument('--devices', type=int, default=4, help='devices per capture')
+    parser.add_argument('--format', choices=('pcap', 'pcapng'), default='pcap')
+    parser.add_argument('--linktype', choices=tuple(synthetic.LINKTYPES), default='usbmon')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip the peak memory runs')
+    parser.add_argument('--no-render', dest='rendering', action='store_false', help='skip the rendering stages')
+    parser.add_argument('--workdir', help='keep the generated inputs and pictures in this directory')
+    parser.add_argument('--json', help='also write the results as JSON to this file')
+    options = parser.parse_args()
+    # Decoders report unknown data through the echo helpers, keep the table readable
+    set_level('success')
+
+    failures = check_fixtures()
+    stages: list[Stage] = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outdir = options.workdir or tmpdir
+        os.makedirs(outdir, exist_ok=True)
+        for size in options.size or [1000, 100_000]:
+            for kind in options.kind or KINDS:
+                filepath, expected = generate(kind, size, options, outdir)
+                pipeline = Pipeline(kind, size, options.memory)
+                result = RUNNERS[kind](pipeline, filepath, options.rendering, outdir)
+                matched = result == expected
+                failures += not matched
+                for stage in pipeline.stages:
+                    peak = '' if stage.peak is None else f'{stage.peak / 1024 / 1024:10.1f} MiB'
+                    print(f'{kind:8s} {size:>10d} {stage.name:12s} {stage.seconds:9.3f} s '
+                          f'{size / max(stage.seconds, 1e-9):14,.0f} reports/s {peak}')
+                print(f'{kind:8s} {size:>10d} {"check":12s} {"ok" if matched else "MISMATCH"}')
+                stages += pipeline.stages
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump([stage._asdict() for stage in stages], f, indent=2)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
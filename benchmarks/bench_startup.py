@@ -0,0 +1,83 @@
+"""
+Startup-time benchmark of the DataExtractor CLI.
+
+Runs a few typical invocations in fresh interpreters and reports the median
+wall time, then checks which heavy modules each invocation imported.
+
+    python benchmarks/bench_startup.py [-n 10] [--max-ms 1500]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+"""
+Repository root
+"""
+
+SCRIPT = os.path.join(ROOT, 'dataextractor.py')
+"""
+CLI entry script
+"""
+
+CASES = {
+    'help': ['--help'],
+    'keyboard': ['-f', os.path.join(ROOT, 'keyboard_test', 'example.pcap'), '--no-cache', '-l', 'success', 'keyboard'],
+}
+"""
+Benchmarked invocations
+"""
+
+HEAVY_MODULES = {
+    'help': ('matplotlib', 'numpy'),
+    'keyboard': ('matplotlib', ),
+}
+"""
+Modules that must not be imported by each benchmarked invocation
+"""
+
+IMPORT_PROBE = '''
+import sys, runpy
+sys.argv = [{script!r}, *{args!r}]
+try:
+    runpy.run_path({script!r}, run_name='__main__')
+except SystemExit:
+    pass
+print('\\n'.join(sorted(sys.modules)), file=sys.stderr)
+'''
+
+def time_case(args: list[str], repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, SCRIPT, *args], cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def heavy_imports(name: str, args: list[str]):
+    probe = IMPORT_PROBE.format(script=SCRIPT, args=args)
+    result = subprocess.run([sys.executable, '-c', probe], cwd=ROOT, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+    modules = set(result.stderr.split())
+    return [module for module in HEAVY_MODULES[name] if module in modules]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--repeat', type=int, default=10, help='runs per case')
+    parser.add_argument('--max-ms', type=float, default=None, help='fail if a median exceeds it')
+    options = parser.parse_args()
+
+    failed = False
+    for name, args in CASES.items():
+        median = time_case(args, options.repeat)
+        heavy = heavy_imports(name, args)
+        print(f'{name:10s} {median:8.1f} ms  heavy imports: {", ".join(heavy) or "none"}')
+        if heavy or (options.max_ms is not None and median > options.max_ms):
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
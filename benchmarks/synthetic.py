@@ -0,0 +1,240 @@
+"""
+Synthetic USB captures and mice logs for the benchmarks.
+
+Keyboard and mouse reports are generated with NumPy and written in chunks
+of fixed-size records, so even captures of tens of millions of reports are
+produced quickly and without holding the whole file in memory.
+
+    python benchmarks/synthetic.py keyboard -n 1000000 --devices 4 --format pcapng -o keyboard.pcapng
+"""
+import argparse
+import struct
+import numpy as np
+
+LINKTYPES = {
+    'usbmon': 189,
+    'usbmon-mmapped': 220,
+    'usbpcap': 249,
+}
+"""
+Supported link types by name
+"""
+
+KEYBOARD_ALPHABET = (
+    [(chr(ord('a') + i), 4 + i, False) for i in range(26)] +
+    [(chr(ord('A') + i), 4 + i, True) for i in range(26)] +
+    [(str((i + 1) % 10), 30 + i, False) for i in range(10)] +
+    [(' ', 44, False), ('-', 45, False), ('_', 45, True), ('{', 47, True), ('}', 48, True), ('.', 55, False)]
+)
+"""
+Characters typed by the synthetic keyboards: (character, key code, with SHIFT)
+"""
+
+CHUNK_SIZE = 1 << 20
+"""
+Records built and written at once
+"""
+
+TIMESTAMP_STEP = 1000
+"""
+Microseconds between two packets
+"""
+
+def keyboard_reports(count: int, seed: int = 0):
+    """
+    Reports of a keyboard typing random text, every key press followed by a release
+
+    Param:
+        count - number of reports (rounded down to an even number)
+
+        seed - random seed
+
+    Returns:
+        (reports, text) N x 8 uint8 array and the typed text
+    """
+    rng = np.random.default_rng(seed)
+    choices = rng.integers(len(KEYBOARD_ALPHABET), size=count // 2)
+    codes = np.array([code for _, code, _ in KEYBOARD_ALPHABET], dtype=np.uint8)
+    shifts = np.array([shift for _, _, shift in KEYBOARD_ALPHABET], dtype=bool)
+    reports = np.zeros((count // 2 * 2, 8), dtype=np.uint8)
+    reports[0::2, 0] = shifts[choices] * 0x02
+    reports[0::2, 2] = codes[choices]
+    text = ''.join(np.array([char for char, _, _ in KEYBOARD_ALPHABET])[choices].tolist())
+    return reports, text
+
+def mouse_reports(count: int, seed: int = 0):
+    """
+    Reports of a mouse moving randomly with the left or right button sometimes held
+
+    Param:
+        count - number of reports
+
+        seed - random seed
+
+    Returns:
+        N x 4 uint8 array (buttons, x, y, wheel)
+    """
+    rng = np.random.default_rng(seed)
+    reports = np.zeros((count, 4), dtype=np.uint8)
+    # Buttons are held for runs of reports rather than flipped every report
+    runs = rng.integers(3, size=count // 64 + 1).astype(np.uint8)
+    reports[:, 0] = np.repeat(runs, 64)[:count]
+    reports[:, 1:3] = rng.integers(-8, 9, size=(count, 2)).astype(np.int8).view(np.uint8)
+    return reports
+
+def micelog_packets(count: int, packet_size: int = 3, seed: int = 0):
+    """
+    Packets of a /dev/input/mice log
+
+    Param:
+        count - number of packets
+
+        packet_size - 3 or 4
+
+        seed - random seed
+
+    Returns:
+        N x packet_size uint8 array
+    """
+    reports = mouse_reports(count, seed)
+    packets = np.zeros((count, packet_size), dtype=np.uint8)
+    # Like the mousedev driver: bit 3 always set, bits 4 and 5 are the signs of the movements
+    packets[:, 0] = reports[:, 0] | 0x08 | (reports[:, 1] >= 0x80) << 4 | (reports[:, 2] >= 0x80) << 5
+    packets[:, 1:3] = reports[:, 1:3]
+    return packets
+
+def packet_header(linktype: int, device: int, length: int):
+    """
+    USB header of an interrupt IN completion carrying `length` bytes
+
+    Param:
+        linktype - 189, 220 or 249
+
+        device - device address, bus is always 1 and endpoint 1
+
+        length - payload length
+    """
+    if linktype == LINKTYPES['usbpcap']:
+        # headerLen, irpId, status, function, info (PDO -> FDO), bus, device, endpoint, transfer, dataLength
+        return struct.pack('<HQIHBHHBBI', 27, 0, 0, 0x09, 0x01, 1, device, 0x81, 0x01, length)
+    header = struct.pack('<QcBBBHccqiiII8s', 0, b'C', 0x01, 0x81, device, 1, b'\x00', b'\x00',
+                         0, 0, 0, length, length, b'')
+    if linktype == LINKTYPES['usbmon-mmapped']:
+        header += bytes(16)
+    return header
+
+def packet_records(reports: np.ndarray, devices: int, linktype: int, pcapng: bool, start: int = 0):
+    """
+    Build the records of a chunk of reports as an N x record-size uint8 array
+
+    Param:
+        reports - N x report-size uint8 array, report i belongs to device i % devices
+
+        devices - number of devices
+
+        linktype - link type
+
+        pcapng - build Enhanced Packet Blocks instead of pcap records
+
+        start - index of the first report, for timestamps and devices
+    """
+    count, length = reports.shape
+    index = np.arange(start, start + count, dtype=np.uint64)
+    headers = np.stack([np.frombuffer(packet_header(linktype, device + 1, length), dtype=np.uint8)
+                        for device in range(devices)])
+    packet_size = headers.shape[1] + length
+    timestamps = index * TIMESTAMP_STEP
+    if pcapng:
+        padded = (packet_size + 3) // 4 * 4
+        record_size = 28 + padded + 4
+        records = np.zeros((count, record_size), dtype=np.uint8)
+        fields = records[:, :28].view('<u4')
+        fields[:, 0] = 6
+        fields[:, 1] = record_size
+        fields[:, 3] = (timestamps >> np.uint64(32)).astype(np.uint32)
+        fields[:, 4] = timestamps.astype(np.uint32)
+        fields[:, 5] = packet_size
+        fields[:, 6] = packet_size
+        records[:, -4:].view('<u4')[:, 0] = record_size
+        offset = 28
+    else:
+        record_size = 16 + packet_size
+        records = np.zeros((count, record_size), dtype=np.uint8)
+        fields = records[:, :16].view('<u4')
+        fields[:, 0] = (timestamps // np.uint64(1_000_000)).astype(np.uint32)
+        fields[:, 1] = (timestamps % np.uint64(1_000_000)).astype(np.uint32)
+        fields[:, 2] = packet_size
+        fields[:, 3] = packet_size
+        offset = 16
+    records[:, offset:offset + headers.shape[1]] = headers[(index % np.uint64(devices)).astype(np.intp)]
+    records[:, offset + headers.shape[1]:offset + packet_size] = reports
+    return records
+
+def file_header(linktype: int, pcapng: bool):
+    """
+    pcap global header, or pcapng section header and interface description blocks
+    """
+    if pcapng:
+        return (struct.pack('<IIIHHqI', 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28) +
+                struct.pack('<IIHHII', 1, 20, linktype, 0, 65535, 20))
+    return struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, linktype)
+
+def write_capture(filepath: str, reports: np.ndarray, devices: int = 1, linktype: int = LINKTYPES['usbmon'],
+                  pcapng: bool = False):
+    """
+    Write reports as a capture, interleaving them between the devices
+
+    Param:
+        filepath - output path
+
+        reports - N x report-size uint8 array, report i belongs to device i % devices
+
+        devices - number of devices, their ids are `1.<n>.1` (`host` never appears)
+
+        linktype - link type
+
+        pcapng - write pcapng instead of pcap
+    """
+    with open(filepath, 'wb') as f:
+        f.write(file_header(linktype, pcapng))
+        for start in range(0, len(reports), CHUNK_SIZE):
+            packet_records(reports[start:start + CHUNK_SIZE], devices, linktype, pcapng, start).tofile(f)
+
+def interleave(reports: np.ndarray, devices: int):
+    """
+    Repeat a report stream for every device, so report i belongs to device i % devices
+    """
+    return np.repeat(reports, devices, axis=0)
+
+def write_micelog(filepath: str, packets: np.ndarray):
+    """
+    Write mice log packets
+    """
+    with open(filepath, 'wb') as f:
+        for start in range(0, len(packets), CHUNK_SIZE):
+            packets[start:start + CHUNK_SIZE].tofile(f)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('kind', choices=('keyboard', 'mice', 'micelog'))
+    parser.add_argument('-n', '--count', type=int, default=100_000, help='total reports, split between the devices (packets for micelog)')
+    parser.add_argument('--devices', type=int, default=1, help='number of devices')
+    parser.add_argument('--format', choices=('pcap', 'pcapng'), default='pcap')
+    parser.add_argument('--linktype', choices=tuple(LINKTYPES), default='usbmon')
+    parser.add_argument('--packet-size', type=int, choices=(3, 4), default=3, help='micelog packet size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', required=True)
+    options = parser.parse_args()
+
+    if options.kind == 'micelog':
+        write_micelog(options.output, micelog_packets(options.count, options.packet_size, options.seed))
+        return
+    if options.kind == 'keyboard':
+        reports, _ = keyboard_reports(options.count // options.devices, options.seed)
+    else:
+        reports = mouse_reports(options.count // options.devices, options.seed)
+    write_capture(options.output, interleave(reports, options.devices), options.devices,
+                  LINKTYPES[options.linktype], options.format == 'pcapng')
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,21 @@
+import ast
+import contextlib
+import functools
+import glob
+import io
+import multiprocessing
 import pkgutil
 import importlib
 import click
 import hashlib
 import os
-from extensions import set_level
+import sys
+import tempfile
+import time
+from extensions import set_level, set_sample_limit, summary_echo, success_echo, fail_echo, parallel_map, parallel_echo_map
+from extensions.utils import LazyDict, file_sha1, file_fingerprint
+from extensions.cacheutils import ReportCache, CACHE_SIZE_LIMIT
+from extensions.profileutils import stage, enable_profiling, disable_profiling, write_profile
 
 FILE_SUFFIX = '.qsdz'
 """
@@ -20,19 +32,385 @@ SCRIPT_NAME = 'DataExtractor'
 This script's name
 """
 
-@click.group()
-@click.option('-f', '--file', required=True, type=click.Path(exists=True), help='source')
+CACHE_DIRNAME = 'dataextractor-cache'
+"""
+Directory name of the decoded-capture cache
+"""
+
+CHECKPOINT_DIRNAME = 'dataextractor-checkpoints'
+"""
+Directory name of the incremental processing checkpoints
+"""
+
+EXTENSION_PACKAGE = 'extensions'
+"""
+The package holding the plugin modules
+"""
+
+EXTENSION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), EXTENSION_PACKAGE)
+"""
+The path to the plugin modules
+"""
+
+HELPER_SUFFIX = 'utils'
+"""
+Modules in the plugin package ending with it are helpers, not plugins
+"""
+
+SERVER_OPTIONS = ('level', 'samples', 'cache', 'cache_limit', 'fast_hash')
+"""
+Group options a server job may override
+"""
+
+CHAINED_CONTEXTS: list[click.Context] = []
+"""
+Contexts of the chained plugins, inherited by the forked workers running them
+"""
+
+def expand_inputs(patterns: tuple[str]):
+    """
+    Expand input files, directories (recursively) and glob patterns
+
+    Param:
+        patterns - `-f` values
+
+    Returns:
+        Sorted, deduplicated file paths
+    """
+    filepaths = []
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise click.BadParameter(f'No file matches {pattern!r}', param_hint="'-f' / '--file'")
+        for match in matches:
+            if os.path.isdir(match):
+                filepaths += [os.path.join(root, name) for root, _, names in os.walk(match) for name in names]
+            elif os.path.exists(match):
+                filepaths.append(match)
+            else:
+                raise click.BadParameter(f'Path {match!r} does not exist.', param_hint="'-f' / '--file'")
+    return sorted(set(map(os.path.abspath, filepaths)))
+
+def run_job(job: tuple[str, list[str], dict, bool]):
+    """
+    Run the CLI on a single file with the console output captured, used by batch mode
+
+    Param:
+        job - (file path, subcommand arguments, group parameters, whether to profile it)
+
+    Returns:
+        (file path, captured output, whether it succeeded, profile or None)
+    """
+    filepath, args, params, profiling = job
+    output = io.StringIO()
+    succeeded = True
+    if profiling:
+        enable_profiling()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            # Files are already processed concurrently, chained plugins run one after another
+            run.main(['-f', filepath, *args], prog_name=SCRIPT_NAME, standalone_mode=False, default_map=dict(params, jobs=1))
+        except click.ClickException as e:
+            e.show()
+            succeeded = False
+        except Exception as e:
+            click.echo(f'{type(e).__name__}: {e}')
+            succeeded = False
+    report = disable_profiling()
+    if report is not None:
+        report = dict(file=filepath, command=args[0], **report)
+    return filepath, output.getvalue(), succeeded, report
+
+class ChainedPluginError(Exception):
+    """
+    Picklable form of a click exception raised by a chained plugin, a click
+    exception holds its context and can not be sent back from a worker
+    """
+
+    def __init__(self, index: int, usage: bool, exit_code: int, message: str):
+        super().__init__(index, usage, exit_code, message)
+
+    def reraise(self, contexts: list[click.Context]):
+        """
+        Raise the original kind of click exception again, against the plugin's context in this process
+        """
+        index, usage, exit_code, message = self.args
+        error = click.UsageError(message, contexts[index]) if usage else click.ClickException(message)
+        error.exit_code = exit_code
+        raise error from None
+
+def invoke_chained(index: int):
+    """
+    Invoke one of the chained plugins, used by the chain workers
+
+    Param:
+        index - position of the plugin in CHAINED_CONTEXTS
+
+    Returns:
+        The plugin's return value
+    """
+    sub_ctx = CHAINED_CONTEXTS[index]
+    try:
+        # Stages of chained plugins are profiled under their names
+        with sub_ctx, stage(sub_ctx.info_name) if len(CHAINED_CONTEXTS) > 1 else contextlib.nullcontext():
+            return sub_ctx.command.invoke(sub_ctx)
+    except click.ClickException as e:
+        raise ChainedPluginError(index, isinstance(e, click.UsageError), e.exit_code, e.format_message()) from None
+
+def build_job(request: dict, defaults: dict, plugins: list[str]):
+    """
+    Turn a server request into a run_job argument
+
+    Param:
+        request - {'file': ..., 'plugin': ..., 'args': [...], 'options': {...}, 'profile': bool}
+
+        defaults - group options of the server
+
+        plugins - available plugin names
+
+    Returns:
+        (file path, subcommand arguments, group parameters, whether to profile it)
+    """
+    if not isinstance(request, dict):
+        raise ValueError('A job must be a JSON object')
+    plugin = request.get('plugin')
+    if plugin not in plugins:
+        raise ValueError(f'Unknown plugin: {plugin!r}')
+    filepath = os.path.abspath(request.get('file') or '')
+    if not os.path.isfile(filepath):
+        raise ValueError(f'Path {filepath!r} does not exist.')
+    options = request.get('options', {})
+    if not isinstance(options, dict):
+        raise ValueError('options must be a JSON object')
+    unknown = set(options) - set(SERVER_OPTIONS)
+    if unknown:
+        raise ValueError(f'Unknown options: {", ".join(sorted(unknown))}')
+    args = request.get('args', [])
+    if not isinstance(args, list):
+        raise ValueError('args must be a JSON list')
+    args = [plugin, *map(str, args)]
+    return filepath, args, {**defaults, **options}, bool(request.get('profile'))
+
+class ExtensionGroup(click.Group):
+    """
+    Click group listing the plugins without importing them.
+
+    A plugin module is only imported when its subcommand is invoked, the
+    help listing uses the module docstrings read from source.
+    """
+
+    def list_commands(self, ctx: click.Context):
+        names = [name for _, name, _ in pkgutil.iter_modules([EXTENSION_PATH])
+                 if not name.endswith(HELPER_SUFFIX)]
+        return sorted(set(names) | set(self.commands))
+
+    def get_command(self, ctx: click.Context, cmd_name: str):
+        if cmd_name in self.commands:
+            return self.commands[cmd_name]
+        if cmd_name not in self.list_commands(ctx):
+            return None
+        module = importlib.import_module(f'{EXTENSION_PACKAGE}.{cmd_name}')
+        command = getattr(module, 'parse', None)
+        if command is not None:
+            self.commands[cmd_name] = command
+        return command
+
+    def invoke(self, ctx: click.Context):
+        if ctx.params['serve'] is not None:
+            return self.invoke_serve(ctx)
+        if not ctx.params['file']:
+            raise click.MissingParameter(ctx=ctx, param=next(param for param in self.params if param.name == 'file'))
+        filepaths = expand_inputs(ctx.params['file'])
+        if len(filepaths) == 1 or not self.remaining_args(ctx):
+            ctx.params['file'] = filepaths
+            if not self.remaining_args(ctx):
+                return super().invoke(ctx)
+            return self.invoke_chain(ctx)
+        return self.invoke_batch(ctx, filepaths)
+
+    def invoke_chain(self, ctx: click.Context):
+        """
+        Run the chained plugins on one file.
+
+        The capture is extracted once when several plugins decode USB
+        reports, each device going to the plugin of its report kind; the
+        plugins then run concurrently in forked workers.
+        """
+        args = self.remaining_args(ctx)
+        ctx.args = []
+        if hasattr(ctx, '_protected_args'):
+            ctx._protected_args = []
+        else:
+            ctx.protected_args = []
+        with ctx:
+            ctx.invoked_subcommand = '*'
+            click.Command.invoke(self, ctx)
+            contexts = []
+            while args:
+                cmd_name, cmd, args = self.resolve_command(ctx, args)
+                sub_ctx = cmd.make_context(cmd_name, args, parent=ctx, allow_extra_args=True, allow_interspersed_args=False)
+                contexts.append(sub_ctx)
+                args, sub_ctx.args = sub_ctx.args, []
+            ctx.invoked_subcommand = ' '.join(sub_ctx.info_name for sub_ctx in contexts)
+
+            kinds = [kind for kind in map(self.report_kind, contexts) if kind is not None]
+            if len(kinds) > 1:
+                from extensions.usbutils import get_hiddata_mapping, route_hiddata_mapping
+                hiddata_mapping = get_hiddata_mapping(ctx.obj['filepath'], False, ctx.obj['cache'], ctx.params['jobs'])
+                with stage('routing'):
+                    ctx.obj['routed_hiddata'] = route_hiddata_mapping(hiddata_mapping, kinds)
+
+            # The workers find the contexts in CHAINED_CONTEXTS, which only forking hands down
+            jobs = min(ctx.params['jobs'], len(contexts)) if multiprocessing.get_start_method() == 'fork' else 1
+            CHAINED_CONTEXTS[:] = contexts
+            try:
+                return list(parallel_echo_map(invoke_chained, [(index, ) for index in range(len(contexts))], jobs))
+            except ChainedPluginError as e:
+                e.reraise(contexts)
+            finally:
+                CHAINED_CONTEXTS.clear()
+
+    @staticmethod
+    def report_kind(sub_ctx: click.Context):
+        """
+        Kind of USB reports a plugin decodes, None if it does not decode USB reports
+        """
+        return getattr(sys.modules[sub_ctx.command.callback.__module__], 'REPORT_KIND', None)
+
+    @staticmethod
+    def remaining_args(ctx: click.Context):
+        """
+        The subcommand and its arguments, not parsed yet
+        """
+        # Click 8.2 keeps the subcommand name in a private attribute
+        protected_args = ctx._protected_args if hasattr(ctx, '_protected_args') else ctx.protected_args
+        return [*protected_args, *ctx.args]
+
+    def invoke_batch(self, ctx: click.Context, filepaths: list[str]):
+        """
+        Run the subcommand on every file in a process pool, printing each file's output in input order
+        """
+        set_level(ctx.params['level'])
+        args = self.remaining_args(ctx)
+        # Import the plugins before forking so the workers share them
+        for cmd_name in set(args) & set(self.list_commands(ctx)):
+            self.get_command(ctx, cmd_name)
+        params = {name: value for name, value in ctx.params.items() if name not in ('file', 'jobs', 'profile', 'serve')}
+        profile = ctx.params['profile']
+        jobs = [(filepath, args, params, bool(profile)) for filepath in filepaths]
+        failures = 0
+        reports = []
+        start = time.perf_counter()
+        for filepath, output, succeeded, report in parallel_map(run_job, jobs, ctx.params['jobs']):
+            (success_echo if succeeded else fail_echo)(f'File: {filepath}')
+            click.echo(output, nl=False)
+            failures += not succeeded
+            reports.append(report)
+        if profile:
+            write_profile(dict(wall=time.perf_counter() - start, files=reports), profile)
+        if failures:
+            ctx.exit(1)
+
+    def invoke_serve(self, ctx: click.Context):
+        """
+        Serve jobs from a long-lived process pool with every plugin already imported
+        """
+        from extensions.serverutils import JobRunner, serve, warm_up
+        set_level(ctx.params['level'])
+        plugins = self.list_commands(ctx)
+        # Import everything before forking so the workers start warm
+        for cmd_name in plugins:
+            self.get_command(ctx, cmd_name)
+        warm_up()
+        defaults = {name: ctx.params[name] for name in SERVER_OPTIONS}
+        runner = JobRunner(run_job, functools.partial(build_job, defaults=defaults, plugins=plugins), ctx.params['jobs'])
+        try:
+            serve(ctx.params['serve'], runner, plugins, lambda address: success_echo(f'Serving on {address}'))
+        except (ValueError, OSError) as e:
+            raise click.ClickException(f'Could not serve on {ctx.params["serve"]}: {e}')
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter):
+        rows = [(name, self.command_summary(name)) for name in self.list_commands(ctx)]
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+
+    def command_summary(self, cmd_name: str):
+        """
+        First line of a plugin's module docstring, read without importing it
+        """
+        if cmd_name in self.commands:
+            return self.commands[cmd_name].get_short_help_str()
+        try:
+            with open(os.path.join(EXTENSION_PATH, f'{cmd_name}.py'), encoding='utf-8') as f:
+                docstring = ast.get_docstring(ast.parse(f.read())) or ''
+        except (OSError, SyntaxError):
+            return ''
+        return docstring.strip().split('\n')[0]
+
+def temp_dir():
+    """
+    Directory holding the caches and checkpoints, `TEMP` if set, otherwise the system temporary directory
+
+    Never the working directory, so recursive runs over `.` do not walk into them.
+    """
+    return os.getenv('TEMP') or tempfile.gettempdir()
+
+def tmp_location(obj: dict):
+    """
+    Pick a temporary file for the input file
+
+    Param:
+        obj - context object holding `filehash` and `filedir`
+
+    Returns:
+        (tmpname, tmppath)
+    """
+    tmpname = obj['filehash'] + FILE_SUFFIX
+    tmppath = os.path.join(os.getenv('TEMP', './'), tmpname)
+    # If temporary file paths conflict, generate new temporary file paths
+    while os.path.exists(tmppath):
+        tmpname = hashlib.sha1(tmpname.encode()).hexdigest() + FILE_SUFFIX
+        tmppath = os.path.join(os.getenv('TEMP', obj['filedir']), tmpname)
+    obj['tmpname'] = tmpname
+    obj['tmppath'] = tmppath
+    return tmpname, tmppath
+
+def hash_file(filepath: str, fast_hash: bool):
+    """
+    Identify the input file
+
+    Param:
+        filepath - file path
+
+        fast_hash - use the sampled fingerprint instead of SHA1
+
+    Returns:
+        Hexadecimal digest
+    """
+    with stage('hashing'):
+        return (file_fingerprint if fast_hash else file_sha1)(filepath)
+
+@click.group(cls=ExtensionGroup, chain=True)
+@click.option('-f', '--file', multiple=True, help='source (required unless serving), repeat it or pass a directory/glob to process many files')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=os.cpu_count() or 1, show_default=True, help='Worker processes when processing many files, chaining plugins or serving')
 @click.option('-l', '--level', type=click.Choice(['success', 'normal', 'debug']))
+@click.option('--samples', type=int, default=5, show_default=True, help='Failed messages shown per reason, -1 shows all')
+@click.option('--cache/--no-cache', default=True, help='Cache the extracted reports of the input file')
+@click.option('--cache-limit', type=int, default=CACHE_SIZE_LIMIT // (1024 * 1024), show_default=True, help='Cache size limit (MiB)')
+@click.option('--fast-hash', is_flag=True, default=False, help='Identify the input file by size, mtime and sampled blocks instead of SHA1')
+@click.option('--profile', metavar='FILE', help='Write wall time, CPU time, peak RSS and record counts of every stage as JSON to FILE, - for the standard output')
+@click.option('--serve', metavar='ADDRESS', help='Serve jobs on a Unix socket (unix:PATH) or an HTTP port ([HOST:]PORT) instead of processing -f')
 @click.version_option(VERSION, '-v', '--version', prog_name=SCRIPT_NAME)
 @click.pass_context
-def run(ctx: click.Context, file: str, level: str):
+def run(ctx: click.Context, file: list[str], jobs: int, level: str, samples: int, cache: bool, cache_limit: int, fast_hash: bool, profile: str, serve: str):
     """
     This script helps extract data from traffic files, log files, and various other files.
 
     —— qsdz (qingsiduzou@gmail.com)
     """
-    ctx.ensure_object(dict)
-    filepath = os.path.abspath(file)
+    ctx.obj = LazyDict(ctx.obj or {})
+    filepath = file[0]
     # Save context - the full path to the input file
     ctx.obj['filepath'] = filepath
     # Save context - input file directory path
@@ -40,33 +418,29 @@ def run(ctx: click.Context, file: str, level: str):
     # Save context - the filename of the input file
     ctx.obj['filename'] = os.path.basename(filepath)
 
-    with open(file, 'rb') as f:
-        data = f.read()
-        # Save context - the hash of the input file
-        ctx.obj['filehash'] = hashlib.sha1(data).hexdigest()
+    # Everything derived from the file content is only computed when first asked for
+    # Save context - the hash of the input file
+    ctx.obj.lazy('filehash', lambda obj: hash_file(obj['filepath'], fast_hash))
     # Save context - the temporary file name of the input file
-    ctx.obj['tmpname'] = ctx.obj['filehash'] + FILE_SUFFIX
-    tmppath = os.path.join(os.getenv('TEMP', './'), ctx.obj['tmpname'])
-    # If temporary file paths conflict, generate new temporary file paths
-    while os.path.exists(tmppath):
-        ctx.obj['tmpname'] = hashlib.sha1(ctx.obj['tmpname'].encode()).hexdigest() + FILE_SUFFIX
-        tmppath = os.path.join(os.getenv('TEMP', ctx.obj['filedir']), ctx.obj['tmpname'])
+    ctx.obj.lazy('tmpname', lambda obj: tmp_location(obj)[0])
     # Save context - temporary directory for input files
-    ctx.obj['tmppath'] = tmppath
+    ctx.obj.lazy('tmppath', lambda obj: tmp_location(obj)[1])
+    # Save context - the decoded-capture cache of the input file, None if disabled
+    ctx.obj['cachedir'] = os.path.join(temp_dir(), CACHE_DIRNAME)
+    ctx.obj.lazy('cache', lambda obj: ReportCache(obj['cachedir'], obj['filehash'], cache_limit * 1024 * 1024) if cache else None)
+    # Save context - checkpoints of the incremental plugins
+    ctx.obj['checkpointdir'] = os.path.join(temp_dir(), CHECKPOINT_DIRNAME)
 
     ctx.obj['level'] = level
     set_level(level)
+    set_sample_limit(samples)
+    # Summarize the repeated failures once the plugin is done
+    ctx.call_on_close(summary_echo)
+    # Measure every stage of the plugin, written once it is done
+    if profile:
+        enable_profiling()
+        ctx.call_on_close(lambda: write_profile(dict(file=filepath, command=ctx.invoked_subcommand,
+                                                     **disable_profiling()), profile))
 
 if __name__ == '__main__':
-    # The path to the plugin module.
-    extension_path = "extensions"
-    # All the plugin modules.
-    extensions = {}
-    # Iterate through and import the respective plugins.
-    for finder, name, ispkg in pkgutil.iter_modules([extension_path]):
-        extensions[name] = importlib.import_module(f'{extension_path}.{name}')
-    # All the plugin names.
-    extension_names = tuple(extensions.keys())
-    for name in extension_names:
-        run.add_command(getattr(extensions[name], 'parse', None), name)
-    run()
\ No newline at end of file
+    run()
@@ -1,6 +1,13 @@
 import click
+import contextlib
+import io
 import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from typing import Callable, Iterable, Sequence, Union
 from enum import IntEnum
+from .profileutils import profiling, enable_profiling, disable_profiling, merge_profile
 
 class EchoLevel(IntEnum):
     """
@@ -15,6 +22,41 @@ ECHO_LEVEL: EchoLevel = EchoLevel.DEBUG
 echo message level variable
 """
 
+ECHO_SAMPLE_LIMIT: int = 5
+"""
+How many failed messages of the same reason are echoed, the rest are only counted
+"""
+
+FAIL_COUNTS: Counter = Counter()
+"""
+Failed message counts per reason
+"""
+
+FAIL_SHOWN: Counter = Counter()
+"""
+Echoed failed message counts per reason
+"""
+
+DEBUG_COUNTS: Counter = Counter()
+"""
+Sampled debug message counts per reason
+"""
+
+DEBUG_SHOWN: Counter = Counter()
+"""
+Echoed sampled debug message counts per reason
+"""
+
+ECHO_COUNTERS = (FAIL_COUNTS, FAIL_SHOWN, DEBUG_COUNTS, DEBUG_SHOWN)
+"""
+Message counters merged from the parallel_echo_map workers
+"""
+
+Message = Union[str, Callable[[], str]]
+"""
+A message, or a function building it only when it is actually echoed
+"""
+
 def set_level(level: str):
     """
     Set the message level.
@@ -30,6 +72,19 @@ def set_level(level: str):
     else:
         ECHO_LEVEL = EchoLevel.NORMAL
 
+def set_sample_limit(limit: int):
+    """
+    Set how many failed messages of the same reason are echoed.
+
+    Param:
+        limit: number of messages, negative for no limit
+    """
+    global ECHO_SAMPLE_LIMIT
+    ECHO_SAMPLE_LIMIT = limit
+
+def format_msg(msg: Message):
+    return msg() if callable(msg) else msg
+
 def success_echo(msg: str):
     """
     Echo successful message
@@ -40,25 +95,90 @@ def success_echo(msg: str):
     if EchoLevel.SUCCESS <= ECHO_LEVEL:
         click.echo(click.style(f'[+] {msg}', fg='green'))
 
-def fail_echo(msg: str):
+def fail_echo(msg: Message, reason: str = None):
     """
     Echo failed message
 
     Param:
-        msg - failed message
+        msg - failed message, or a function building it
+
+        reason - messages sharing a reason are counted, and only the first
+            ECHO_SAMPLE_LIMIT of them are echoed
     """
+    if reason is not None:
+        FAIL_COUNTS[reason] += 1
+        if 0 <= ECHO_SAMPLE_LIMIT <= FAIL_SHOWN[reason]:
+            return
+        FAIL_SHOWN[reason] += 1
     if EchoLevel.NORMAL <= ECHO_LEVEL:
-        click.echo(click.style(f'[-] {msg}', fg='red'))
+        click.echo(click.style(f'[-] {format_msg(msg)}', fg='red'))
+
+def fail_echo_many(reason: str, items: Sequence, describe: Callable[[object], str]):
+    """
+    Count a batch of failures of one reason and echo the first samples
+
+    Param:
+        reason - failure reason
+
+        items - the failed items, such as indexes of bad reports
 
-def debug_echo(msg: str):
+        describe - builds the message of an item, only called for echoed samples
+    """
+    FAIL_COUNTS[reason] += len(items)
+    samples = sample_count(FAIL_SHOWN, reason, len(items))
+    FAIL_SHOWN[reason] += samples
+    if EchoLevel.NORMAL <= ECHO_LEVEL:
+        for item in items[:samples]:
+            click.echo(click.style(f'[-] {describe(item)}', fg='red'))
+
+def sample_count(shown: Counter, reason: str, count: int):
+    """
+    How many of `count` more messages of a reason can still be echoed
+    """
+    return count if ECHO_SAMPLE_LIMIT < 0 else min(max(ECHO_SAMPLE_LIMIT - shown[reason], 0), count)
+
+def debug_echo(msg: Message):
     """
     Echo debug message
 
     Param:
-        msg - debug message
+        msg - debug message, or a function building it
     """
     if EchoLevel.DEBUG <= ECHO_LEVEL:
-        click.echo(click.style(f'[*] {msg}', fg='cyan'))
+        click.echo(click.style(f'[*] {format_msg(msg)}', fg='cyan'))
+
+def debug_echo_many(reason: str, items: Sequence, describe: Callable[[object], str]):
+    """
+    Count a batch of debug messages of one reason and echo the first samples,
+    nothing is counted or built unless debug messages are echoed
+
+    Param:
+        reason - message reason, such as 'Parse'
+
+        items - the items, such as indexes of parsed reports
+
+        describe - builds the message of an item, only called for echoed samples
+    """
+    if ECHO_LEVEL < EchoLevel.DEBUG:
+        return
+    DEBUG_COUNTS[reason] += len(items)
+    samples = sample_count(DEBUG_SHOWN, reason, len(items))
+    DEBUG_SHOWN[reason] += samples
+    for item in items[:samples]:
+        click.echo(click.style(f'[*] {describe(item)}', fg='cyan'))
+
+def summary_echo():
+    """
+    Echo how many failed and sampled debug messages of each reason were not shown, then reset the counts
+    """
+    for reason, count in FAIL_COUNTS.items():
+        if count > FAIL_SHOWN[reason]:
+            fail_echo(f'{reason}: {count} in total, {count - FAIL_SHOWN[reason]} not shown')
+    for reason, count in DEBUG_COUNTS.items():
+        if count > DEBUG_SHOWN[reason]:
+            debug_echo(f'{reason}: {count} in total, {count - DEBUG_SHOWN[reason]} not shown')
+    for counter in ECHO_COUNTERS:
+        counter.clear()
 
 def call_outer(cmd: list[str], timeout: int = 60):
     """
@@ -74,4 +194,117 @@ def call_outer(cmd: list[str], timeout: int = 60):
     process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     outputs, errs = process.communicate(timeout=timeout)
     process.kill()
-    return outputs, errs
\ No newline at end of file
+    return outputs, errs
+
+class OuterProcessError(click.ClickException):
+    """
+    An outer program is missing or exited with a failure status
+    """
+
+def iter_outer(cmd: list[str]):
+    """
+    Call outer process and yield its standard output line by line
+
+    Param:
+        cmd - commands
+
+    Returns:
+        A generator of output lines (without line breaks)
+
+    Raises:
+        OuterProcessError - the program is missing or exited with a non-zero status, once its output is exhausted
+    """
+    # Standard error goes to a file so a chatty program never blocks on a full pipe
+    with tempfile.TemporaryFile() as errs:
+        try:
+            process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=errs, text=True)
+        except FileNotFoundError:
+            raise OuterProcessError(f'{cmd[0]} is not installed')
+        try:
+            for line in process.stdout:
+                yield line.rstrip('\n')
+            returncode = process.wait()
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+        if returncode != 0:
+            errs.seek(0)
+            raise OuterProcessError(f'{cmd[0]} exited with status {returncode}: {errs.read().decode(errors="replace").strip()}')
+
+def parallel_map(func: Callable, items: Iterable, jobs: int = 1):
+    """
+    Map a function over items in a process pool, results come back in input order
+
+    Param:
+        func - picklable (module level) function
+
+        items - arguments of each call
+
+        jobs - number of worker processes, 1 runs everything in this process
+
+    Returns:
+        A generator of results, each yielded as soon as it and all before it are done
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        yield from map(func, items)
+        return
+    with ProcessPoolExecutor(max_workers=min(jobs, len(items))) as executor:
+        yield from executor.map(func, items)
+
+def captured_call(job: tuple[Callable, tuple, EchoLevel, int, bool]):
+    """
+    Call a function with its echoed messages captured, used by parallel_echo_map workers
+
+    Param:
+        job - (function, arguments, echo level, sample limit, whether to profile the call)
+
+    Returns:
+        (result, captured output, message counts of ECHO_COUNTERS, profile or None)
+    """
+    global ECHO_LEVEL, ECHO_SAMPLE_LIMIT
+    func, args, ECHO_LEVEL, ECHO_SAMPLE_LIMIT, profile = job
+    for counter in ECHO_COUNTERS:
+        counter.clear()
+    # A forked worker inherits the parent's profiler, every call starts a fresh one
+    if profile:
+        enable_profiling()
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            result = func(*args)
+    finally:
+        report = disable_profiling()
+    return result, output.getvalue(), tuple(map(Counter, ECHO_COUNTERS)), report
+
+def parallel_echo_map(func: Callable, items: Iterable[tuple], jobs: int = 1):
+    """
+    Call a function on every argument tuple in a process pool, echoing each call's
+    messages in input order and merging its failure counts and profiled stages
+    into this process
+
+    Param:
+        func - picklable (module level) function
+
+        items - argument tuples of each call
+
+        jobs - number of worker processes, 1 calls everything directly in this process
+
+    Returns:
+        A generator of results in input order
+    """
+    items = list(items)
+    # A single call would run in this process anyway, captured_call must not replace its profiler
+    if jobs <= 1 or len(items) <= 1:
+        for args in items:
+            yield func(*args)
+        return
+    calls = [(func, args, ECHO_LEVEL, ECHO_SAMPLE_LIMIT, profiling()) for args in items]
+    for result, output, counts, report in parallel_map(captured_call, calls, jobs):
+        click.echo(output, nl=False)
+        for counter, count in zip(ECHO_COUNTERS, counts):
+            counter.update(count)
+        merge_profile(report)
+        yield result
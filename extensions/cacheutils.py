@@ -0,0 +1,170 @@
+from .pcaputils import UsbReport
+from .profileutils import stage
+from .utils import ReportBuffer
+from typing import Iterable
+import os
+import struct
+
+EXTRACTOR_VERSION = 2
+"""
+Version of the extracted report format, bump it whenever the extraction changes
+"""
+
+CACHE_MAGIC = b'DEXCACHE'
+"""
+Magic number of a cache file
+"""
+
+CACHE_SUFFIX = '.cache'
+"""
+Cache file suffix
+"""
+
+CACHE_SIZE_LIMIT = 512 * 1024 * 1024
+"""
+Default size limit (bytes) of the whole cache directory
+"""
+
+CACHE_HEADER = struct.Struct('<8sI')
+"""
+magic, extractor version
+"""
+
+CACHE_RECORD = struct.Struct('<dHI')
+"""
+timestamp, device index, payload length
+"""
+
+CACHE_FOOTER = struct.Struct('<I')
+"""
+length of the device table
+"""
+
+class ReportCache:
+    """
+    On-disk cache of the USB reports extracted from one capture.
+
+    A cache file is a header, the records (each followed by its payload) and
+    a device table footer, so it can be written while the capture is still
+    being extracted. Files are evicted least recently used first once the
+    directory grows over `limit` bytes.
+    """
+
+    def __init__(self, cachedir: str, filehash: str, limit: int = CACHE_SIZE_LIMIT):
+        self.cachedir = cachedir
+        self.limit = limit
+        self.path = os.path.join(cachedir, f'{filehash}-v{EXTRACTOR_VERSION}{CACHE_SUFFIX}')
+
+    def load(self):
+        """
+        Load the cached reports
+
+        Returns:
+            A generator of UsbReport, None if nothing is cached
+        """
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return None
+        magic, version = CACHE_HEADER.unpack(f.read(CACHE_HEADER.size))
+        if magic != CACHE_MAGIC or version != EXTRACTOR_VERSION:
+            f.close()
+            return None
+        # Mark as recently used
+        os.utime(self.path)
+        return self._iter_records(f)
+
+    def load_buffer(self):
+        """
+        Load the cached reports into a ReportBuffer whose payloads point into the cache file contents
+
+        Returns:
+            ReportBuffer, None if nothing is cached
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < CACHE_HEADER.size + CACHE_FOOTER.size or CACHE_HEADER.unpack_from(data) != (CACHE_MAGIC, EXTRACTOR_VERSION):
+            return None
+        # Mark as recently used
+        os.utime(self.path)
+        with stage('cache') as recorder:
+            end = len(data) - CACHE_FOOTER.size
+            table_len, = CACHE_FOOTER.unpack_from(data, end)
+            end -= table_len
+            buffer = ReportBuffer(data[end:end + table_len].decode().split('\n') if table_len else [], data)
+            pos = CACHE_HEADER.size
+            while pos < end:
+                timestamp, device_index, length = CACHE_RECORD.unpack_from(data, pos)
+                pos += CACHE_RECORD.size
+                buffer.offsets.append(pos)
+                buffer.lengths.append(length)
+                buffer.devices.append(device_index)
+                buffer.timestamps.append(timestamp)
+                pos += length
+            recorder.add(len(buffer))
+        return buffer
+
+    def _iter_records(self, f):
+        with f:
+            f.seek(-CACHE_FOOTER.size, os.SEEK_END)
+            end = f.tell()
+            table_len, = CACHE_FOOTER.unpack(f.read(CACHE_FOOTER.size))
+            end -= table_len
+            f.seek(end)
+            devices = f.read(table_len).decode().split('\n')
+            f.seek(CACHE_HEADER.size)
+            while f.tell() < end:
+                timestamp, device_index, length = CACHE_RECORD.unpack(f.read(CACHE_RECORD.size))
+                yield UsbReport(timestamp, devices[device_index], f.read(length))
+
+    def store(self, reports: Iterable[UsbReport]):
+        """
+        Pass the reports through while writing them into the cache.
+
+        The cache file only appears once the reports are exhausted.
+
+        Param:
+            reports - USB reports
+
+        Returns:
+            A generator of the same UsbReport
+        """
+        os.makedirs(self.cachedir, exist_ok=True)
+        partpath = f'{self.path}.{os.getpid()}.part'
+        devices = {}
+        try:
+            with open(partpath, 'wb') as f:
+                f.write(CACHE_HEADER.pack(CACHE_MAGIC, EXTRACTOR_VERSION))
+                for report in reports:
+                    device_index = devices.setdefault(report.device_id, len(devices))
+                    f.write(CACHE_RECORD.pack(report.timestamp, device_index, len(report.data)))
+                    f.write(report.data)
+                    yield report
+                table = '\n'.join(devices).encode()
+                f.write(table)
+                f.write(CACHE_FOOTER.pack(len(table)))
+            os.replace(partpath, self.path)
+        finally:
+            if os.path.exists(partpath):
+                os.remove(partpath)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used cache files until the directory fits the limit
+        """
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            stat = os.stat(os.path.join(self.cachedir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.limit:
+                break
+            os.remove(os.path.join(self.cachedir, name))
+            total -= size
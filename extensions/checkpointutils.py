@@ -0,0 +1,96 @@
+from .utils import HASH_CHUNK_SIZE
+from typing import Optional
+import hashlib
+import json
+import os
+import numpy as np
+
+CHECKPOINT_VERSION = 1
+"""
+Version of the checkpoint format, bump it whenever a plugin's saved state changes
+"""
+
+CHECKPOINT_SUFFIX = '.checkpoint'
+"""
+Checkpoint file suffix, the arrays are saved next to it with `.npz` appended
+"""
+
+TAIL_SIZE = 4096
+"""
+Bytes right before the checkpointed offset that must not change between runs
+"""
+
+def region_sha1(filepath: str, start: int, size: int):
+    """
+    SHA1 of `size` bytes of a file starting at `start`
+    """
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        return hashlib.sha1(f.read(size)).hexdigest()
+
+class Checkpoint:
+    """
+    Progress of a plugin on a growing capture.
+
+    Holds the file offset processed so far, the reader state needed to
+    resume there and the plugin's per-device state. The checkpoint is keyed
+    by the file path rather than its hash, which changes as the file grows;
+    it is dropped when the already processed part of the file changed, such
+    as after a ring buffer rotated into the same path.
+    """
+
+    def __init__(self, checkpointdir: str, filepath: str, plugin: str):
+        self.checkpointdir = checkpointdir
+        self.filepath = filepath
+        key = hashlib.sha1(os.path.abspath(filepath).encode()).hexdigest()
+        self.path = os.path.join(checkpointdir, f'{key}-{plugin}{CHECKPOINT_SUFFIX}')
+
+    def signature(self, offset: int):
+        """
+        Head and tail hashes of the first `offset` bytes of the file
+        """
+        head = min(offset, HASH_CHUNK_SIZE)
+        tail = min(offset, TAIL_SIZE)
+        return [region_sha1(self.filepath, 0, head), region_sha1(self.filepath, offset - tail, tail)]
+
+    def load(self):
+        """
+        Load the checkpoint
+
+        Returns:
+            (offset, reader state, device states, arrays), None if there is no valid checkpoint
+        """
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            arrays = dict(np.load(f'{self.path}.npz')) if saved['arrays'] else {}
+        except (OSError, ValueError, KeyError):
+            return None
+        if saved.get('version') != CHECKPOINT_VERSION or os.path.getsize(self.filepath) < saved['offset']:
+            return None
+        if saved['signature'] != self.signature(saved['offset']):
+            return None
+        return saved['offset'], saved['reader'], saved['devices'], arrays
+
+    def save(self, offset: int, reader: dict, devices: dict, arrays: Optional[dict[str, np.ndarray]] = None):
+        """
+        Save the checkpoint, replacing the previous one atomically
+
+        Param:
+            offset - file offset processed so far
+
+            reader - JSON-serializable reader state
+
+            devices - JSON-serializable per-device state
+
+            arrays - NumPy arrays of the state, by name
+        """
+        os.makedirs(self.checkpointdir, exist_ok=True)
+        if arrays:
+            with open(f'{self.path}.npz.part', 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(f'{self.path}.npz.part', f'{self.path}.npz')
+        with open(f'{self.path}.part', 'w') as f:
+            json.dump(dict(version=CHECKPOINT_VERSION, offset=offset, signature=self.signature(offset),
+                           reader=reader, devices=devices, arrays=bool(arrays)), f)
+        os.replace(f'{self.path}.part', self.path)
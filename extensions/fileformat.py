@@ -0,0 +1,50 @@
+"""
+Dump the structure of BMP, PNG and ZIP files as JSON
+"""
+from . import success_echo, fail_echo, debug_echo
+from .formatutils import UnknownFormat, detect_format, select, write_json
+from .profileutils import stage
+import click
+import mmap
+import os
+import struct
+
+@click.command()
+@click.option('-d', '--debug', is_flag=True, default=False, help='Enable debug information')
+@click.option('-s', '--select', 'path', default='', help='Only dump the value at a dotted path, such as info_header.width or chunks.0')
+@click.option('--data', is_flag=True, default=False, help='Include bulk data: BMP palette and pixel rows, PNG chunk data')
+@click.option('--compact', is_flag=True, default=False, help='Write compact JSON without indentation')
+@click.pass_context
+def parse(ctx: click.Context, debug: bool, path: str, data: bool, compact: bool):
+    filepath = ctx.obj['filepath']
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            fail_echo('Empty file')
+            return
+        # Only the pages of the fields that are written are read from disk
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            try:
+                parser = detect_format(buf)
+            except UnknownFormat as e:
+                fail_echo(str(e))
+                return
+            ### DEBUG
+            if debug:
+                debug_echo(f'Detected format: {parser.__name__[len("parse_"):]}')
+            output_filename = f'{ctx.obj["filehash"]}.json'
+            try:
+                with stage('dumping'), open(f'{output_filename}.part', 'w') as output:
+                    value = parser(buf, data)
+                    if path:
+                        value = select(value, path.split('.'))
+                    write_json(value, output, None if compact else 2)
+                    output.write('\n')
+            except KeyError as e:
+                fail_echo(f'No such field: {e}')
+            except (UnknownFormat, struct.error, ValueError) as e:
+                fail_echo(f'Could not parse this file: {e}')
+            else:
+                os.replace(f'{output_filename}.part', output_filename)
+                success_echo(f'Output saved in ./{output_filename}')
+                return
+    os.remove(f'{output_filename}.part')
@@ -0,0 +1,398 @@
+from typing import Callable, Iterable, Optional, TextIO
+import itertools
+import json
+import struct
+import numpy as np
+
+MAGIC_SIZE = 8
+"""
+Bytes read from the start of a file to detect its format
+"""
+
+ZIP_COMMENT_MAX = 0xffff
+"""
+Maximum size of a ZIP archive comment, bounding the search for the end of central directory record
+"""
+
+BMP_FILE_HEADER = (('signature', '2s'), ('size', 'I'), ('reserved1', 'H'), ('reserved2', 'H'), ('pixel_offset', 'I'))
+"""
+BITMAPFILEHEADER fields
+"""
+
+BMP_CORE_HEADER = (('header_size', 'I'), ('width', 'H'), ('height', 'H'), ('planes', 'H'), ('bit_count', 'H'))
+"""
+BITMAPCOREHEADER fields (OS/2 bitmaps)
+"""
+
+BMP_INFO_HEADER = (('header_size', 'I'), ('width', 'i'), ('height', 'i'), ('planes', 'H'), ('bit_count', 'H'),
+                   ('compression', 'I'), ('image_size', 'I'), ('x_pixels_per_meter', 'i'), ('y_pixels_per_meter', 'i'),
+                   ('colors_used', 'I'), ('colors_important', 'I'))
+"""
+BITMAPINFOHEADER fields, also the start of the V4 and V5 headers
+"""
+
+PNG_IHDR = (('width', 'I'), ('height', 'I'), ('bit_depth', 'B'), ('color_type', 'B'), ('compression', 'B'),
+            ('filter', 'B'), ('interlace', 'B'))
+"""
+PNG IHDR chunk fields
+"""
+
+ZIP_END_RECORD = (('signature', '4s'), ('disk', 'H'), ('cd_disk', 'H'), ('disk_entries', 'H'), ('entries', 'H'),
+                  ('cd_size', 'I'), ('cd_offset', 'I'), ('comment_length', 'H'))
+"""
+ZIP end of central directory record fields
+"""
+
+ZIP_CENTRAL_HEADER = (('signature', '4s'), ('version_made_by', 'H'), ('version_needed', 'H'), ('flags', 'H'),
+                      ('compression', 'H'), ('mod_time', 'H'), ('mod_date', 'H'), ('crc32', 'I'),
+                      ('compressed_size', 'I'), ('uncompressed_size', 'I'), ('name_length', 'H'),
+                      ('extra_length', 'H'), ('comment_length', 'H'), ('disk_start', 'H'),
+                      ('internal_attributes', 'H'), ('external_attributes', 'I'), ('local_header_offset', 'I'))
+"""
+ZIP central directory file header fields
+"""
+
+ZIP_LOCAL_HEADER = (('signature', '4s'), ('version_needed', 'H'), ('flags', 'H'), ('compression', 'H'),
+                    ('mod_time', 'H'), ('mod_date', 'H'), ('crc32', 'I'), ('compressed_size', 'I'),
+                    ('uncompressed_size', 'I'), ('name_length', 'H'), ('extra_length', 'H'))
+"""
+ZIP local file header fields
+"""
+
+ZIP_UTF8_FLAG = 0x800
+"""
+General purpose flag marking UTF-8 file names
+"""
+
+class UnknownFormat(Exception):
+    """
+    The file format is not recognized or its structure is broken
+    """
+
+class JsonObject:
+    """
+    A JSON object built lazily from (key, value) pairs.
+
+    A value may be a function, it is only called when the value is written
+    or selected. A generator of pairs can only be walked once.
+    """
+
+    def __init__(self, pairs: Iterable[tuple[str, object]]):
+        self.pairs = pairs
+
+    def __iter__(self):
+        for key, value in self.pairs:
+            yield key, resolve(value)
+
+class JsonArray:
+    """
+    A JSON array built lazily from an iterable, items may be functions like the values of JsonObject
+    """
+
+    def __init__(self, items: Iterable):
+        self.items = items
+
+    def __iter__(self):
+        return map(resolve, self.items)
+
+def resolve(value):
+    """
+    Call a lazy value
+    """
+    return value() if callable(value) else value
+
+def write_json(value, f: TextIO, indent: Optional[int] = 2, level: int = 0):
+    """
+    Write a value as JSON, walking JsonObject and JsonArray as it goes
+
+    Param:
+        value - JSON-serializable value, JsonObject or JsonArray
+
+        f - text file to write to
+
+        indent - spaces per nesting level, None for compact output
+
+        level - current nesting level
+    """
+    value = resolve(value)
+    colon = ': ' if indent is not None else ':'
+    if isinstance(value, JsonObject):
+        brackets, items = '{}', ((json.dumps(str(key)) + colon, item) for key, item in value)
+    elif isinstance(value, JsonArray):
+        brackets, items = '[]', (('', item) for item in value)
+    else:
+        f.write(json.dumps(value, separators=None if indent is not None else (',', ':')))
+        return
+    f.write(brackets[0])
+    separator = ',' if indent is None else ',\n' + ' ' * (indent * (level + 1))
+    empty = True
+    for prefix, item in items:
+        f.write(separator[1:] if empty else separator)
+        f.write(prefix)
+        write_json(item, f, indent, level + 1)
+        empty = False
+    if not empty and indent is not None:
+        f.write('\n' + ' ' * (indent * level))
+    f.write(brackets[1])
+
+def select(value, path: list[str]):
+    """
+    Walk down to a nested value without evaluating its siblings
+
+    Param:
+        value - JsonObject or JsonArray
+
+        path - keys and array indices, such as ['chunks', '0', 'type']
+
+    Returns:
+        The selected value
+
+    Raises:
+        KeyError - a key or index does not exist
+    """
+    for name in path:
+        value = resolve(value)
+        if isinstance(value, JsonObject):
+            value = next((item for key, item in value.pairs if key == name), KeyError)
+        elif isinstance(value, JsonArray) and name.isdigit():
+            value = next(itertools.islice(value.items, int(name), None), KeyError)
+        else:
+            value = KeyError
+        if value is KeyError:
+            raise KeyError(name)
+    return resolve(value)
+
+def read_value(buf, fmt: str, offset: int):
+    """
+    Unpack one field, byte strings become latin-1 text
+    """
+    value, = struct.unpack_from(fmt, buf, offset)
+    return value.decode('latin-1') if isinstance(value, bytes) else value
+
+def read_fields(buf, offset: int, layout: tuple, endian: str = '<'):
+    """
+    Unpack all fields of a structure at once
+
+    Returns:
+        A dict of field values
+    """
+    fmt = endian + ''.join(fmt for _, fmt in layout)
+    values = struct.unpack_from(fmt, buf, offset)
+    return {name: value.decode('latin-1') if isinstance(value, bytes) else value
+            for (name, _), value in zip(layout, values)}
+
+def lazy_fields(buf, offset: int, layout: tuple, endian: str = '<'):
+    """
+    Fields of a structure, each unpacked only when used
+
+    Param:
+        buf - file buffer (mmap)
+
+        offset - start of the structure
+
+        layout - (name, struct format) of every field
+
+        endian - struct byte order prefix
+
+    Returns:
+        A list of (name, lazy value) pairs
+    """
+    pairs = []
+    for name, fmt in layout:
+        pairs.append((name, lambda fmt=endian + fmt, offset=offset: read_value(buf, fmt, offset)))
+        offset += struct.calcsize(endian + fmt)
+    return pairs
+
+def layout_size(layout: tuple, endian: str = '<'):
+    return struct.calcsize(endian + ''.join(fmt for _, fmt in layout))
+
+def bmp_row(buf, offset: int, width: int, bit_count: int):
+    """
+    Pixels of a bitmap row: palette indices below 8 bits per pixel, byte lists (BGR order) above
+    """
+    row = np.frombuffer(buf, np.uint8, count=(width * bit_count + 7) // 8, offset=offset)
+    if bit_count == 8:
+        return row.tolist()
+    if bit_count > 8:
+        return row[:width * (bit_count // 8)].reshape(width, bit_count // 8).tolist()
+    bits = np.unpackbits(row).reshape(-1, bit_count)
+    return bits.dot(1 << np.arange(bit_count - 1, -1, -1))[:width].tolist()
+
+def parse_bmp(buf, data: bool = False):
+    """
+    Structure of a BMP image
+
+    Param:
+        buf - file buffer
+
+        data - Whether to include the palette and pixel rows
+
+    Returns:
+        A JsonObject
+    """
+    header_size = read_value(buf, '<I', 14)
+    layout = BMP_CORE_HEADER if header_size == 12 else BMP_INFO_HEADER
+    pairs = [('format', 'bmp'), ('size', len(buf)),
+             ('file_header', JsonObject(lazy_fields(buf, 0, BMP_FILE_HEADER))),
+             ('info_header', JsonObject(lazy_fields(buf, 14, layout)))]
+    if data:
+        info = read_fields(buf, 14, layout)
+        pairs += [('palette', lambda: bmp_palette(buf, info)), ('rows', lambda: bmp_rows(buf, info))]
+    return JsonObject(pairs)
+
+def bmp_palette(buf, info: dict):
+    bit_count = info['bit_count']
+    if bit_count > 8:
+        return JsonArray([])
+    entry_size = 3 if info['header_size'] == 12 else 4
+    count = info.get('colors_used') or 1 << bit_count
+    offset = 14 + info['header_size']
+    count = min(count, (len(buf) - offset) // entry_size)
+    return JsonArray(lambda i=i: list(buf[offset + i * entry_size:offset + i * entry_size + 3]) for i in range(count))
+
+def bmp_rows(buf, info: dict):
+    """
+    Pixel rows of an uncompressed bitmap, in file order (bottom-up unless the height is negative)
+    """
+    if info.get('compression', 0) != 0:
+        raise UnknownFormat(f'Compressed bitmap (compression {info["compression"]})')
+    width, bit_count = abs(info['width']), info['bit_count']
+    stride = (width * bit_count + 31) // 32 * 4
+    offset = read_value(buf, '<I', 10)
+    rows = min(abs(info['height']), max(len(buf) - offset, 0) // stride) if stride else 0
+    return JsonArray(lambda row=row: bmp_row(buf, offset + row * stride, width, bit_count) for row in range(rows))
+
+def png_chunks(buf, data: bool = False):
+    """
+    Walk the chunks of a PNG image, stopping after IEND or at a truncated chunk
+
+    Returns:
+        A generator of JsonObject
+    """
+    offset = 8
+    while offset + 12 <= len(buf):
+        length, chunk_type = struct.unpack_from('>I4s', buf, offset)
+        end = offset + 12 + length
+        if end > len(buf):
+            return
+        start = offset + 8
+        pairs = [('type', chunk_type.decode('latin-1')), ('offset', offset), ('length', length),
+                 ('crc', lambda end=end: read_value(buf, '>I', end - 4))]
+        if chunk_type == b'IHDR':
+            pairs.append(('data', JsonObject(lazy_fields(buf, start, PNG_IHDR, '>'))))
+        elif chunk_type == b'tEXt':
+            pairs.append(('data', lambda start=start, length=length: png_text(buf, start, length)))
+        elif data:
+            pairs.append(('data', lambda start=start, length=length: buf[start:start + length].hex()))
+        yield JsonObject(pairs)
+        if chunk_type == b'IEND':
+            return
+        offset = end
+
+def png_text(buf, start: int, length: int):
+    keyword, _, text = buf[start:start + length].partition(b'\0')
+    return dict(keyword=keyword.decode('latin-1'), text=text.decode('latin-1'))
+
+def parse_png(buf, data: bool = False):
+    """
+    Structure of a PNG image
+
+    Param:
+        buf - file buffer
+
+        data - Whether to include the data of every chunk as hex, otherwise only IHDR and tEXt are decoded
+
+    Returns:
+        A JsonObject
+    """
+    return JsonObject([('format', 'png'), ('size', len(buf)),
+                       ('header', JsonObject(lazy_fields(buf, 16, PNG_IHDR, '>'))),
+                       ('chunks', JsonArray(png_chunks(buf, data)))])
+
+def zip_name(buf, offset: int, length: int, flags: int):
+    return buf[offset:offset + length].decode('utf-8' if flags & ZIP_UTF8_FLAG else 'cp437', 'replace')
+
+def zip_central_directory(buf, offset: int, entries: int):
+    """
+    Walk the central directory of a ZIP archive
+
+    Returns:
+        A generator of JsonObject
+    """
+    size = layout_size(ZIP_CENTRAL_HEADER)
+    for _ in range(entries):
+        if offset + size > len(buf) or buf[offset:offset + 4] != b'PK\x01\x02':
+            return
+        header = read_fields(buf, offset, ZIP_CENTRAL_HEADER)
+        name = zip_name(buf, offset + size, header['name_length'], header['flags'])
+        yield JsonObject([('name', name), ('offset', offset), *header.items()])
+        offset += size + header['name_length'] + header['extra_length'] + header['comment_length']
+
+def zip_local_files(buf):
+    """
+    Walk the local file headers from the start of a ZIP archive, this also works when the central directory is lost
+
+    Returns:
+        A generator of JsonObject
+    """
+    size = layout_size(ZIP_LOCAL_HEADER)
+    offset = 0
+    while offset + size <= len(buf) and buf[offset:offset + 4] == b'PK\x03\x04':
+        header = read_fields(buf, offset, ZIP_LOCAL_HEADER)
+        data_offset = offset + size + header['name_length'] + header['extra_length']
+        name = zip_name(buf, offset + size, header['name_length'], header['flags'])
+        yield JsonObject([('name', name), ('offset', offset), ('data_offset', data_offset), *header.items()])
+        # Sizes are left zero when they follow the data in a descriptor, the next header can not be found
+        if header['compressed_size'] == 0 and header['flags'] & 0x08:
+            return
+        offset = data_offset + header['compressed_size']
+
+def parse_zip(buf, data: bool = False):
+    """
+    Structure of a ZIP archive
+
+    Param:
+        buf - file buffer
+
+        data - unused, entries never include their data
+
+    Returns:
+        A JsonObject
+    """
+    pairs = [('format', 'zip'), ('size', len(buf))]
+    end = buf.rfind(b'PK\x05\x06', max(len(buf) - ZIP_COMMENT_MAX - layout_size(ZIP_END_RECORD), 0))
+    if end >= 0 and end + layout_size(ZIP_END_RECORD) <= len(buf):
+        record = read_fields(buf, end, ZIP_END_RECORD)
+        pairs += [('end_record', JsonObject([('offset', end), *record.items()])),
+                  ('central_directory', JsonArray(zip_central_directory(buf, record['cd_offset'], record['entries'])))]
+    pairs.append(('local_files', JsonArray(zip_local_files(buf))))
+    return JsonObject(pairs)
+
+FORMAT_MAGICS = (
+    (b'BM', parse_bmp),
+    (b'\x89PNG\r\n\x1a\n', parse_png),
+    (b'PK\x03\x04', parse_zip),
+    (b'PK\x05\x06', parse_zip),
+)
+"""
+Magic numbers at the start of a file and the parser of the format
+"""
+
+def detect_format(buf) -> Callable:
+    """
+    Find the parser of a file from its first bytes
+
+    Param:
+        buf - file buffer
+
+    Returns:
+        The parser, called with the buffer and whether to include bulk data
+
+    Raises:
+        UnknownFormat - no magic number matches
+    """
+    head = bytes(buf[:MAGIC_SIZE])
+    for magic, parser in FORMAT_MAGICS:
+        if head.startswith(magic):
+            return parser
+    raise UnknownFormat(f'Unknown file format, magic: {head.hex()}')
@@ -1,13 +1,21 @@
-from . import success_echo, fail_echo, debug_echo
-from .utils import unhexlify, hexlify
-from .tsharkutils import get_layers
+"""
+Extract keyboard input from USB keyboard traffic
+"""
+from . import success_echo, fail_echo, fail_echo_many, debug_echo, debug_echo_many, parallel_echo_map
+from .utils import ReportBuffer, hexlify, unhexlify
+from .usbutils import get_plugin_hiddata_mapping, get_new_hiddata_mapping, get_usb_reports, KEYBOARD_KIND
+from .pcaputils import UnsupportedCapture, UsbReport
+from .checkpointutils import Checkpoint
+from .profileutils import stage
 import click
 import json
-from collections import defaultdict
+import os
+from typing import Iterable, Optional
+import numpy as np
 
-CAPTURE_FILTER_PARAMS = ('usbhid.data', 'usb.capdata', )
+REPORT_KIND = KEYBOARD_KIND
 """
-Parameters that need to be captured
+Kind of USB reports this plugin decodes, used to route devices when plugins are chained
 """
 
 SPECIAL_KEY = dict(
@@ -85,89 +93,333 @@ SPECIAL_KEYS_MAPPING = {
 A mapping table for special keys.
 """
 
-def keypress_from_hiddata(hiddatas: list[bytes], debug: bool = False):
+SPECIAL_KEYS = frozenset(SPECIAL_KEY.values())
+"""
+All special keys, for constant-time lookups.
+"""
+
+KEY_TABLE = np.array([NORMAL_KEYS_MAPPING.get(code, SPECIAL_KEY['UNKOWN_KEY']) for code in range(256)] +
+                     [SHIFT_KEYS_MAPPING.get(code, SPECIAL_KEY['UNKOWN_KEY']) for code in range(256)], dtype=object)
+"""
+Lookup table of keys, indexed by key code (+ 256 when SHIFT is pressed).
+"""
+
+SHIFT_MODIFIERS = 0b00100010
+"""
+Left shift and right shift bits of the modifier byte.
+"""
+
+FIRST_KEY_CODE = 0x04
+"""
+Key codes below it are "no key" or error codes (such as ErrorRollOver).
+"""
+
+KEYBOARD_REPORT_SIZE = 8
+"""
+Size of a boot keyboard report: modifiers, reserved and six key slots.
+"""
+
+KEYBOARD_CHUNK_SIZE = 1 << 20
+"""
+Reports decoded at once, bounding the temporary arrays.
+"""
+
+KEYBOARD_STREAM_CHUNK_SIZE = 4096
+"""
+Reports of a device buffered before they are decoded and flushed in streaming mode.
+"""
+
+def reports_from_hiddata(hiddatas: ReportBuffer):
+    """
+    Stack hid-datas into an N x 8 array, shorter reports are padded with zeros
+
+    The array is a view of the payload buffer when every report is 8 bytes long.
+
+    Param:
+        hiddatas: hid-datas
+
+    Return:
+        (reports, lengths) uint8 array and the original length of every report
+    """
+    return hiddatas.matrix(KEYBOARD_REPORT_SIZE), hiddatas.column('lengths')
+
+def keypress_from_reports(reports: np.ndarray, lengths: np.ndarray, previous: np.ndarray = None):
+    """
+    Detect key-down events in an N x 8 report array
+
+    Param:
+        reports: keyboard reports
+
+        lengths: original length of every report
+
+        previous: the report before the first one, None if there is none
+
+    Return:
+        (keys, row) the pressed keys and the report index each one comes from
+    """
+    if previous is None:
+        previous = np.zeros(KEYBOARD_REPORT_SIZE, dtype=np.uint8)
+    modifiers = reports[:, 0]
+    slots = reports[:, 2:]
+    last_slots = np.vstack((previous[None, 2:], slots[:-1]))
+    shift = modifiers & SHIFT_MODIFIERS != 0
+    known = (lengths >= 3) & ((modifiers == 0) | shift)
+    # A key is pressed when it shows up in a slot without being in the previous report
+    pressed = (slots >= FIRST_KEY_CODE) & known[:, None]
+    pressed &= ~(slots[:, :, None] == last_slots[:, None, :]).any(axis=2)
+    rows, columns = np.nonzero(pressed)
+    codes = slots[rows, columns].astype(np.int64) + shift[rows] * 256
+    return KEY_TABLE[codes], rows
+
+def keypress_from_hiddata(hiddatas: ReportBuffer, debug: bool = False, previous: bytes = None):
     """
     Generate key information from hid-data
 
+    Every key pressed in any of the six key slots is reported once, when it
+    goes down.
+
     Param:
-        hiddatas: hid-datas, such as [b'\\x00\\x00\\x30\\x00\\x00\\x00\\x00\\x00']
+        hiddatas: hid-datas packed in a ReportBuffer, such as [b'\\x00\\x00\\x30\\x00\\x00\\x00\\x00\\x00']
         debug: Whether to output debugging information, False is default
+
+        previous: the hid-data received before these ones, to resume a decoding
     
     Return:
         A list containing parsed key information
     """
-    # Record the pressed keys and map them to the devices they belong to
+    reports, lengths = reports_from_hiddata(hiddatas)
     pressed_keys = []
-    for hid_data in hiddatas:
-        if hid_data == b'\x00' * 8:
-            # null data
-            continue
-        if hid_data[0] == 0:
-            # normal pressed
-            pressed_keys.append(
-                NORMAL_KEYS_MAPPING.get(hid_data[2], SPECIAL_KEY['UNKOWN_KEY']))
-        elif hid_data[0] & 0b10 != 0 or hid_data[0] & 0b100000 != 0:
-            # left shift or right shift is pressed.
-            pressed_keys.append(
-                SHIFT_KEYS_MAPPING.get(hid_data[2], SPECIAL_KEY['UNKOWN_KEY']))
-        else:
-            # unkown hid-data
-            fail_echo(f'Unkown hid-data: {hexlify(hid_data)}')
-            continue
+    if previous is not None:
+        previous = np.frombuffer(bytes(previous[:KEYBOARD_REPORT_SIZE]).ljust(KEYBOARD_REPORT_SIZE, b'\x00'), dtype=np.uint8)
+    for start in range(0, len(reports), KEYBOARD_CHUNK_SIZE):
+        chunk = reports[start:start + KEYBOARD_CHUNK_SIZE]
+        chunk_lengths = lengths[start:start + KEYBOARD_CHUNK_SIZE]
+        keys, _ = keypress_from_reports(chunk, chunk_lengths, previous)
+        pressed_keys += keys.tolist()
+        previous = chunk[-1]
+
+        modifiers = chunk[:, 0]
+        null = ~chunk.any(axis=1)
+        known = (chunk_lengths >= 3) & ((modifiers == 0) | (modifiers & SHIFT_MODIFIERS != 0))
+        # unkown hid-data
+        fail_echo_many('Unkown hid-data', (np.flatnonzero(~known & ~null) + start).tolist(),
+                       lambda i: f'Unkown hid-data: {hexlify(hiddatas[i])}')
         ### DEBUG
         if debug:
-            debug_echo(f'Parse: {hexlify(hid_data)}')
+            debug_echo_many('Parse', (np.flatnonzero(known & ~null) + start).tolist(),
+                            lambda i: f'Parse: {hexlify(hiddatas[i])}')
     return pressed_keys
 
+def content_from_keypress(keys: list[str], capital: bool = False):
+    """
+    Rebuild the typed text from key information
+
+    Param:
+        keys: parsed key information
+
+        capital: whether caps lock is on before the first key
+
+    Return:
+        A list of typed strings
+    """
+    content = []
+    for key in keys:
+        # Priority should be given to handling special keys.
+        if key == SPECIAL_KEY['CAP_KEY']:
+            capital = not capital
+        elif key in SPECIAL_KEYS:
+            content.append(SPECIAL_KEYS_MAPPING.get(key, ''))
+        else:
+            content.append(key.upper() if capital else key)
+    return content
+
+def capital_after(keys: list[str], capital: bool = False):
+    """
+    Whether caps lock is on after the keys
+
+    Param:
+        keys: parsed key information
+
+        capital: whether caps lock is on before the first key
+    """
+    return capital ^ (keys.count(SPECIAL_KEY['CAP_KEY']) % 2 == 1)
+
+def decode_device(hiddatas: ReportBuffer, debug: bool = False, previous: bytes = None, capital: bool = False):
+    """
+    Decode the hid-datas of one device
+
+    Param:
+        hiddatas: hid-datas of the device
+
+        debug: Whether to output debugging information, False is default
+
+        previous: the hid-data received before these ones, to resume a decoding
+
+        capital: whether caps lock is on before these hid-datas
+
+    Return:
+        (keys, content) parsed key information and the typed strings
+    """
+    with stage('decoding') as recorder:
+        keys = keypress_from_hiddata(hiddatas, debug, previous)
+        recorder.add(len(hiddatas))
+    with stage('text rebuild') as recorder:
+        content = content_from_keypress(keys, capital)
+        recorder.add(len(keys))
+    return keys, content
+
+def keypress_stream(reports: Iterable[UsbReport], debug: bool = False, chunk_size: int = KEYBOARD_STREAM_CHUNK_SIZE):
+    """
+    Decode a stream of USB reports into key information, keeping only the state of each device
+
+    Param:
+        reports: USB reports in capture order
+
+        debug: Whether to output debugging information, False is default
+
+        chunk_size: reports of a device decoded at once
+
+    Return:
+        A generator of (device_id, keys), every device's keys come in order
+    """
+    pending = {}
+    previous = {}
+    for report in reports:
+        hiddatas = pending.setdefault(report.device_id, ReportBuffer())
+        hiddatas.append(*report)
+        if len(hiddatas) >= chunk_size:
+            yield report.device_id, keypress_from_hiddata(hiddatas, debug, previous.get(report.device_id))
+            previous[report.device_id] = bytes(hiddatas[-1])
+            pending[report.device_id] = ReportBuffer()
+    for device_id, hiddatas in pending.items():
+        if hiddatas:
+            yield device_id, keypress_from_hiddata(hiddatas, debug, previous.get(device_id))
+
+def content_stream(keypresses: Iterable[tuple[str, list[str]]]):
+    """
+    Rebuild the typed text of a key information stream, keeping the caps lock state of each device
+
+    Param:
+        keypresses: (device_id, keys) such as the ones of keypress_stream
+
+    Return:
+        A generator of (device_id, keys, content)
+    """
+    capitals = {}
+    for device_id, keys in keypresses:
+        capital = capitals.get(device_id, False)
+        yield device_id, keys, content_from_keypress(keys, capital)
+        capitals[device_id] = capital_after(keys, capital)
+
+def stream_parse(reports: Iterable[UsbReport], output_dir: Optional[str], filehash: Optional[str], debug: bool = False):
+    """
+    Decode keyboard reports as they are read and flush the text incrementally
+
+    Param:
+        reports: USB reports in capture order
+
+        output_dir: directory of the per-device files, None to echo every flushed piece instead
+
+        filehash: input file hash, part of the file names
+
+        debug: Whether to output debugging information, False is default
+    """
+    outputs = {}
+    # Devices without any key yet, echoed with empty text at the end like the non-streaming output
+    silent = {}
+    try:
+        for device_id, keys, content in content_stream(keypress_stream(reports, debug)):
+            if output_dir is None:
+                if keys:
+                    silent[device_id] = False
+                    success_echo(f'Device ID: {device_id}')
+                    success_echo(f'Raw: {"".join(keys)}')
+                    success_echo(f'Content: {"".join(content)}')
+                else:
+                    silent.setdefault(device_id, True)
+                continue
+            if device_id not in outputs:
+                outputs[device_id] = tuple(open(os.path.join(output_dir, f'{filehash}-{device_id}-{kind}.txt'), 'w')
+                                           for kind in ('raw', 'content'))
+            raw_file, content_file = outputs[device_id]
+            raw_file.write(''.join(keys))
+            content_file.write(''.join(content))
+    finally:
+        for raw_file, content_file in outputs.values():
+            raw_file.close()
+            content_file.close()
+    for device_id in (device_id for device_id, empty in silent.items() if empty):
+        success_echo(f'Device ID: {device_id}')
+        success_echo('Raw: ')
+        success_echo('Content: ')
+    for raw_file, content_file in outputs.values():
+        success_echo(f'Output saved in {raw_file.name} and {content_file.name}')
+
 @click.command()
 @click.option('-d', '--debug', is_flag=True, default=False, help='Enable debug information')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1, show_default=True, help='Worker processes extracting the capture and decoding devices concurrently')
+@click.option('-i', '--incremental', is_flag=True, default=False, help='Only decode the packets appended since the last incremental run')
+@click.option('-s', '--stream', is_flag=True, default=False, help='Decode reports as they are read with constant memory, flushing the text piece by piece')
+@click.option('-o', '--output-dir', type=click.Path(file_okay=False), default=None, help='Write the streamed text of every device into files in this directory')
 @click.pass_context
-def parse(ctx: click.Context, debug: bool):
+def parse(ctx: click.Context, debug: bool, jobs: int, incremental: bool, stream: bool, output_dir: Optional[str]):
     filepath = ctx.obj['filepath']
-    tmppath = ctx.obj['tmppath']
-    
-    with open(tmppath, 'w') as tmpio:
-        for filter_param in CAPTURE_FILTER_PARAMS:
-            layers = get_layers(filepath, filter_param, debug)
-
-            ### DEBUG
-            if debug:
-                tmpio.write(json.dumps(layers) + '\n')
-                debug_echo(f'Traffic outputs saved in {tmppath}')
-            
-            hiddata_mapping = defaultdict(list)
-            for layer_pkt in layers:
-                layer_pkt: dict
-                # Get usb packet
-                device_id: int = layer_pkt['usb']['usb.src']
-                # Get usb hid-data
-                hid_data: bytes = layer_pkt[filter_param]
-
-                # hid_data convert
-                hid_data = unhexlify(hid_data)
-                hiddata_mapping[device_id].append(hid_data)
-
-            # Generate output information based on hid-data
-            pressed_keys = {}
-            pressed_contents = {}
-            for device_id, hiddatas in hiddata_mapping.items():
-                keys = keypress_from_hiddata(hiddatas, debug)
-                pressed_keys[device_id] = keys
-                capital = False
-                content = []
-                for key in keys:
-                    key: str
-                    # Priority should be given to handling special keys.
-                    if key == SPECIAL_KEY['CAP_KEY']:
-                        capital = not capital
-                    elif key in SPECIAL_KEY.values():
-                        content.append(SPECIAL_KEYS_MAPPING.get(key, ''))
-                    else:
-                        content.append(key.upper() if capital else key)
-                pressed_contents[device_id] = content
-
-            # Output extracted message
-            for device_id in hiddata_mapping.keys():
-                success_echo(f'Device ID: {device_id}')
-                success_echo(f'Raw: {"".join(pressed_keys[device_id])}')
-                success_echo(f'Content: {"".join(pressed_contents[device_id])}')
+
+    if stream or output_dir is not None:
+        if incremental:
+            raise click.UsageError("'-s' / '--stream' and '-o' / '--output-dir' can not be combined with '-i' / '--incremental'", ctx)
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        # Sharded extraction holds whole shards in memory, the reports are read serially
+        with stage('streaming') as recorder:
+            reports = get_usb_reports(filepath, debug, ctx.obj['cache'])
+            stream_parse(reports, output_dir, ctx.obj['filehash'] if output_dir is not None else None, debug)
+            recorder.add()
+        return
+
+    # Per-device state of the previous run: last hid-data, caps lock, keys and content so far
+    devices = {}
+    if incremental:
+        checkpoint = Checkpoint(ctx.obj['checkpointdir'], filepath, 'keyboard')
+        _, reader, devices, _ = checkpoint.load() or (0, None, {}, {})
+        try:
+            hiddata_mapping, reader = get_new_hiddata_mapping(filepath, reader, debug)
+        except UnsupportedCapture as e:
+            fail_echo(f'{e}, incremental mode is not available')
+            return
+        ### DEBUG
+        if debug:
+            debug_echo(f'Resumed at offset {reader["offset"]} with {len(devices)} known devices')
+    else:
+        hiddata_mapping = get_plugin_hiddata_mapping(ctx.obj, REPORT_KIND, debug, jobs)
+
+    ### DEBUG
+    if debug:
+        tmppath = ctx.obj['tmppath']
+        with open(tmppath, 'w') as tmpio:
+            tmpio.write(json.dumps({device_id: [hexlify(hid_data) for hid_data in hiddatas]
+                                    for device_id, hiddatas in hiddata_mapping.items()}) + '\n')
+            debug_echo(f'Traffic outputs saved in {tmppath}')
+
+    # Generate output information based on hid-data
+    pressed_keys = {device_id: state['keys'] for device_id, state in devices.items()}
+    pressed_contents = {device_id: state['content'] for device_id, state in devices.items()}
+    with stage('devices') as recorder:
+        states = [devices.get(device_id) for device_id in hiddata_mapping.keys()]
+        results = parallel_echo_map(decode_device, [(hiddatas, debug, state and unhexlify(state['previous']), bool(state and state['capital']))
+                                                    for hiddatas, state in zip(hiddata_mapping.values(), states)], jobs)
+        for (device_id, hiddatas), state, (keys, content) in zip(hiddata_mapping.items(), states, results):
+            pressed_keys[device_id] = pressed_keys.get(device_id, []) + keys
+            pressed_contents[device_id] = pressed_contents.get(device_id, []) + content
+            if incremental:
+                devices[device_id] = dict(previous=hexlify(hiddatas[-1]), capital=capital_after(keys, bool(state and state['capital'])),
+                                          keys=pressed_keys[device_id], content=pressed_contents[device_id])
+            recorder.add()
+    if incremental:
+        checkpoint.save(reader['offset'], reader, devices)
+
+    # Output extracted message
+    for device_id in pressed_keys.keys():
+        success_echo(f'Device ID: {device_id}')
+        success_echo(f'Raw: {"".join(pressed_keys[device_id])}')
+        success_echo(f'Content: {"".join(pressed_contents[device_id])}')
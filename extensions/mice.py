@@ -1,17 +1,21 @@
-from . import success_echo, fail_echo, debug_echo
-from .utils import unhexlify, hexlify
-from .tsharkutils import get_layers
+"""
+Extract mouse traces from USB mouse traffic
+"""
+from . import success_echo, fail_echo, fail_echo_many, debug_echo, parallel_echo_map
+from .utils import ReportBuffer, hexlify
+from .usbutils import get_plugin_hiddata_mapping, get_new_hiddata_mapping, MICE_KIND
+from .pcaputils import UnsupportedCapture
+from .checkpointutils import Checkpoint
+from .profileutils import stage
 import click
 import json
-import matplotlib.pyplot as plt
-from collections import defaultdict
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 from enum import IntEnum
-import struct
+import numpy as np
 
-CAPTURE_FILTER_PARAMS = ('usbhid.data', 'usb.capdata', )
+REPORT_KIND = MICE_KIND
 """
-Parameters that need to be captured
+Kind of USB reports this plugin decodes, used to route devices when plugins are chained
 """
 
 class MiceStatus(IntEnum):
@@ -32,43 +36,231 @@ class MiceMsg(NamedTuple):
     status: MiceStatus
     position: MicePosition
 
-def micemsg_from_hiddata(hiddatas: list[bytes], debug: bool = False):
+MICE_REPORT_DTYPES = {
+    4: np.dtype([('pressed', 'u1'), ('x', 'i1'), ('y', 'i1'), ('pad', 'V1')]),
+    8: np.dtype([('pressed', 'u1'), ('pad0', 'V1'), ('x', 'i1'), ('y', 'i1'), ('pad1', 'V4')]),
+}
+"""
+Layouts of the mouse hid-data, keyed by report length
+"""
+
+class MiceTrajectory:
     """
-    Generate mice message from hid-data
+    Array-backed mouse trajectory.
+
+    Behaves like a read-only list of MiceMsg, while `status`, `x` and `y`
+    hold the whole trajectory as NumPy arrays.
+    """
+    __slots__ = ('status', 'x', 'y')
+
+    def __init__(self, status: np.ndarray, x: np.ndarray, y: np.ndarray):
+        self.status = status
+        self.x = x
+        self.y = y
+
+    @classmethod
+    def from_deltas(cls, status: np.ndarray, offset_x: np.ndarray, offset_y: np.ndarray):
+        """
+        Build a trajectory starting at (0, 0) from relative movements
+
+        Param:
+            status - MiceStatus of each report
+
+            offset_x - x movement of each report
+
+            offset_y - y movement of each report
+        """
+        return cls(np.concatenate(([MiceStatus.MOVE], status)).astype(np.uint8),
+                   np.concatenate(([0], np.cumsum(offset_x, dtype=np.int64))),
+                   np.concatenate(([0], np.cumsum(offset_y, dtype=np.int64))))
+
+    @classmethod
+    def from_micemsgs(cls, micemsgs: list[MiceMsg]):
+        """
+        Build a trajectory from a MiceMsg list
+        """
+        return cls(np.array([msg.status for msg in micemsgs], dtype=np.uint8),
+                   np.array([msg.position.x for msg in micemsgs], dtype=np.int64),
+                   np.array([msg.position.y for msg in micemsgs], dtype=np.int64))
+
+    def extend(self, status: np.ndarray, offset_x: np.ndarray, offset_y: np.ndarray):
+        """
+        Continue the trajectory from its last point with relative movements
+
+        Param:
+            status - MiceStatus of each report
+
+            offset_x - x movement of each report
+
+            offset_y - y movement of each report
+
+        Returns:
+            A new MiceTrajectory
+        """
+        return MiceTrajectory(np.concatenate((self.status, status)).astype(np.uint8),
+                              np.concatenate((self.x, self.x[-1] + np.cumsum(offset_x, dtype=np.int64))),
+                              np.concatenate((self.y, self.y[-1] + np.cumsum(offset_y, dtype=np.int64))))
+
+    def __len__(self):
+        return len(self.status)
+
+    def __getitem__(self, index: int):
+        return MiceMsg(MiceStatus(self.status[index]), MicePosition(int(self.x[index]), int(self.y[index])))
+
+    def __iter__(self):
+        for status, x, y in zip(self.status.tolist(), self.x.tolist(), self.y.tolist()):
+            yield MiceMsg(MiceStatus(status), MicePosition(x, y))
+
+    def runs(self):
+        """
+        Split the trajectory where the status changes
+
+        Returns:
+            A generator of (status, start, stop)
+        """
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(self.status)) + 1, [len(self.status)]))
+        for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            if start < stop:
+                yield MiceStatus(self.status[start]), start, stop
+
+def deltas_from_hiddata(hiddatas: ReportBuffer, debug: bool = False):
+    """
+    Decode hid-data into statuses and relative movements
 
     Param:
-        hiddatas: hid-datas, such as [b'\\x00\\x00\\x02\\x00\\x00\\x00\\x00\\x00']
+        hiddatas: hid-datas packed in a ReportBuffer, such as [b'\\x00\\x00\\x02\\x00\\x00\\x00\\x00\\x00']
         
         debug: Whether to output debugging information, False is default
     
     Return:
-        A list containing parsed mice message(MiceMsg)
-    """
-    position = MicePosition(0, 0)
-    micemsg: list[MiceMsg] = [MiceMsg(MiceStatus.MOVE, position)]
-    for hid_data in hiddatas:
-        if len(hid_data) == 4:
-            pressed, offset_x, offset_y = struct.unpack('Bbbx', hid_data)
-        elif len(hid_data) == 8:
-            pressed, offset_x, offset_y = struct.unpack('Bxbbxxxx', hid_data)
-        else:
-            fail_echo(f'Unkown hid-data: {hexlify(hid_data)}')
-            continue
-        try:
-            status = MiceStatus(pressed)
-        except:
-            fail_echo(f'Unkown hid-data: {hexlify(hid_data)}')
+        status, offset_x, offset_y arrays of the valid reports (y pointing up)
+    """
+    lengths = hiddatas.column('lengths')
+    pressed = np.full(len(hiddatas), 0xff, dtype=np.uint8)
+    offset_x = np.zeros(len(hiddatas), dtype=np.int64)
+    offset_y = np.zeros(len(hiddatas), dtype=np.int64)
+    for length, dtype in MICE_REPORT_DTYPES.items():
+        index = np.flatnonzero(lengths == length)
+        if not index.size:
             continue
-        position = MicePosition(position.x + offset_x, position.y - offset_y)
-        micemsg.append(MiceMsg(status, position))
-    return micemsg
+        # A view of the payload buffer when the device only sends reports of this length
+        reports = hiddatas.matrix(length, None if index.size == len(hiddatas) else index).view(dtype)[:, 0]
+        pressed[index] = reports['pressed']
+        offset_x[index] = reports['x']
+        offset_y[index] = reports['y']
+    # Unknown lengths keep the 0xff marker and are dropped with unknown buttons
+    valid = pressed <= max(MiceStatus)
+    fail_echo_many('Unkown hid-data', np.flatnonzero(~valid).tolist(),
+                   lambda i: f'Unkown hid-data: {hexlify(hiddatas[i])}')
+    return pressed[valid], offset_x[valid], -offset_y[valid]
+
+def micemsg_from_hiddata(hiddatas: ReportBuffer, debug: bool = False):
+    """
+    Generate mice message from hid-data
+
+    Param:
+        hiddatas: hid-datas packed in a ReportBuffer, such as [b'\\x00\\x00\\x02\\x00\\x00\\x00\\x00\\x00']
+        
+        debug: Whether to output debugging information, False is default
+    
+    Return:
+        A MiceTrajectory containing parsed mice message
+    """
+    return MiceTrajectory.from_deltas(*deltas_from_hiddata(hiddatas, debug))
+
+MICE_COLORS = ('c', 'r', 'b')
+"""
+Trace colors of move, left and right
+"""
+
+MICE_ALPHAS = (0.5, 1, 1)
+"""
+Trace alphas of move, left and right
+"""
+
+HEATMAP_BINS = 512
+"""
+Number of bins per axis of a heatmap
+"""
+
+def status_trace(micemsgs: MiceTrajectory, status: MiceStatus):
+    """
+    Coordinates of every run of one status, runs separated by NaN
+
+    Param:
+        micemsgs - MiceTrajectory
+
+        status - MiceStatus to be extracted
+
+    Returns:
+        x, y float arrays
+    """
+    index = np.flatnonzero(micemsgs.status == status)
+    # A run ends wherever the next point of this status is not the next message
+    breaks = np.flatnonzero(np.diff(index) != 1) + 1
+    trace_x = np.insert(micemsgs.x[index].astype(np.float64), breaks, np.nan)
+    trace_y = np.insert(micemsgs.y[index].astype(np.float64), breaks, np.nan)
+    return trace_x, trace_y
+
+def simplify_trajectory(micemsgs: MiceTrajectory, tolerance: float = 0.0, max_points: Optional[int] = None):
+    """
+    Drop the points that do not change the drawn shape of a trajectory.
+
+    Ramer-Douglas-Peucker, splitting every open segment at once in each
+    round. The first and last point of every status run are always kept,
+    so button transitions stay where they were.
+
+    Param:
+        micemsgs - MiceTrajectory
+
+        tolerance - largest distance (in mouse units) a dropped point may be from the simplified line
+
+        max_points - stop once this many points are kept, the farthest points are added first within a round
 
-def handle_micemsgs(micemsgs: list[MiceMsg], position: tuple, colors: tuple[str, str, str], alphas: tuple[float, float, float]):
+    Return:
+        (simplified MiceTrajectory, number of dropped points)
+    """
+    count = len(micemsgs)
+    x = micemsgs.x.astype(np.float64)
+    y = micemsgs.y.astype(np.float64)
+    keep = np.zeros(count, dtype=bool)
+    changes = np.flatnonzero(np.diff(micemsgs.status))
+    keep[changes] = keep[changes + 1] = True
+    keep[[0, -1]] = count > 0
+    kept = int(np.count_nonzero(keep))
+    active = np.flatnonzero(~keep)
+    while active.size and (max_points is None or kept < max_points):
+        bounds = np.flatnonzero(keep)
+        segment = np.searchsorted(bounds, active) - 1
+        start, end = bounds[segment], bounds[segment + 1]
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[active] - x[start], y[active] - y[start]
+        norm = np.hypot(dx, dy)
+        # Distance to the chord, or to its start when both ends are the same point
+        distance = np.where(norm > 0, np.abs(dx * py - dy * px) / np.where(norm > 0, norm, 1), np.hypot(px, py))
+        firsts = np.concatenate(([0], np.flatnonzero(np.diff(segment)) + 1))
+        sizes = np.diff(np.append(firsts, active.size))
+        maxima = np.maximum.reduceat(distance, firsts)
+        hits = np.flatnonzero(distance == np.repeat(maxima, sizes))
+        _, first_hits = np.unique(np.searchsorted(firsts, hits, 'right') - 1, return_index=True)
+        opened = maxima > tolerance
+        splits, split_distances = hits[first_hits][opened], maxima[opened]
+        if max_points is not None and kept + splits.size > max_points:
+            splits = splits[np.argsort(-split_distances, kind='stable')[:max_points - kept]]
+        keep[active[splits]] = True
+        kept += splits.size
+        # Points of closed segments are settled
+        remaining = np.repeat(opened, sizes)
+        remaining[splits] = False
+        active = active[remaining]
+    return MiceTrajectory(micemsgs.status[keep], micemsgs.x[keep], micemsgs.y[keep]), count - kept
+
+def handle_micemsgs(micemsgs: MiceTrajectory, position: tuple, colors: tuple[str, str, str], alphas: tuple[float, float, float]):
     """
-    Parse MiceMsg output pictures
+    Parse MiceMsg output pictures, one line artist per status
 
     Param:
-        micemsgs - MiceMsg list
+        micemsgs - MiceTrajectory (or MiceMsg list)
 
         position - The position to be extracted
 
@@ -79,67 +271,209 @@ def handle_micemsgs(micemsgs: list[MiceMsg], position: tuple, colors: tuple[str,
     Return:
         fig, ax
     """
-    trace_x = []
-    trace_y = []
-    last_status = micemsgs[0].status
-    fig, ax = plt.subplots()
-    for msg in micemsgs:
-        if msg.status != last_status:
-            # Plot
-            if MICE_STATUS_FLAGS[last_status] in position:
-                ax.plot(trace_x, trace_y, color=colors[last_status], alpha=alphas[last_status])
-            trace_x = []
-            trace_y = []
-            last_status = msg.status
-        trace_x.append(msg.position.x)
-        trace_y.append(msg.position.y)
-    if MICE_STATUS_FLAGS[last_status] in position:
-        ax.plot(trace_x, trace_y, color=colors[last_status], alpha=alphas[last_status])
+    # matplotlib is slow to import, only load it once something is drawn
+    from matplotlib.figure import Figure
+    if not isinstance(micemsgs, MiceTrajectory):
+        micemsgs = MiceTrajectory.from_micemsgs(micemsgs)
+    fig = Figure()
+    ax = fig.subplots()
+    for status in MiceStatus:
+        if MICE_STATUS_FLAGS[status] in position and np.any(micemsgs.status == status):
+            trace_x, trace_y = status_trace(micemsgs, status)
+            ax.plot(trace_x, trace_y, color=colors[status], alpha=alphas[status])
+    return fig, ax
+
+def heatmap_micemsgs(micemsgs: MiceTrajectory, position: tuple, bins: int = HEATMAP_BINS):
+    """
+    Parse MiceMsg output density pictures, for traces too large to draw as lines
+
+    Param:
+        micemsgs - MiceTrajectory (or MiceMsg list)
+
+        position - The position to be extracted
+
+        bins - Number of bins per axis
+
+    Return:
+        fig, ax
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.colors import LogNorm
+    if not isinstance(micemsgs, MiceTrajectory):
+        micemsgs = MiceTrajectory.from_micemsgs(micemsgs)
+    fig = Figure()
+    ax = fig.subplots()
+    statuses = [status for status in MiceStatus if MICE_STATUS_FLAGS[status] in position]
+    selected = np.isin(micemsgs.status, statuses)
+    if np.any(selected):
+        counts, edges_x, edges_y = np.histogram2d(micemsgs.x[selected], micemsgs.y[selected], bins=bins)
+        ax.imshow(np.ma.masked_equal(counts.T, 0), origin='lower', aspect='auto', norm=LogNorm(),
+                  extent=(edges_x[0], edges_x[-1], edges_y[0], edges_y[-1]))
     return fig, ax
 
+def render_device(device_id: str, hiddatas: ReportBuffer, position: tuple, heatmap: bool, filehash: str,
+                  simplify: tuple[float, Optional[int]] = (0.0, None), debug: bool = False):
+    """
+    Decode the hid-datas of one device and save its picture
+
+    Param:
+        device_id - device id, part of the picture name
+
+        hiddatas - hid-datas of the device
+
+        position - The position to be extracted
+
+        heatmap - Draw a density heatmap instead of lines
+
+        filehash - input file hash, part of the picture name
+
+        simplify - (tolerance, point budget) of the line simplification, see simplify_micemsgs
+
+        debug - Whether to output debugging information, False is default
+
+    Return:
+        The picture file name, None if there was nothing to draw
+    """
+    with stage('decoding') as recorder:
+        micemsgs = micemsg_from_hiddata(hiddatas, debug)
+        recorder.add(len(hiddatas))
+    output_filename = f'{filehash}-{device_id}-heatmap.png' if heatmap else f'{filehash}-{device_id}.png'
+    return render_trajectory(micemsgs, position, heatmap, output_filename, simplify)
+
+def simplify_micemsgs(micemsgs: MiceTrajectory, simplify: tuple[float, Optional[int]], output_filename: str):
+    """
+    Simplify a trajectory before it is drawn as lines, when requested
+
+    Param:
+        micemsgs - MiceTrajectory
+
+        simplify - (tolerance, point budget), (0, None) draws every point
+
+        output_filename - picture file name, used in the report
+
+    Return:
+        The MiceTrajectory to draw
+    """
+    tolerance, max_points = simplify
+    if not tolerance and max_points is None:
+        return micemsgs
+    with stage('simplifying') as recorder:
+        simplified, dropped = simplify_trajectory(micemsgs, tolerance, max_points)
+        recorder.add(len(micemsgs))
+    success_echo(f'Dropped {dropped} of {len(micemsgs)} points drawing ./{output_filename}')
+    if max_points is not None and len(simplified) > max_points:
+        fail_echo(f'Kept {len(simplified)} points drawing ./{output_filename}, over the budget of {max_points}: the points around status transitions are always kept')
+    return simplified
+
+def render_trajectory(micemsgs: MiceTrajectory, position: tuple, heatmap: bool, output_filename: str,
+                      simplify: tuple[float, Optional[int]] = (0.0, None)):
+    """
+    Save the picture of a trajectory
+
+    Param:
+        micemsgs - MiceTrajectory
+
+        position - The position to be extracted
+
+        heatmap - Draw a density heatmap instead of lines
+
+        output_filename - picture file name
+
+        simplify - (tolerance, point budget) of the line simplification, ignored by heatmaps
+
+    Return:
+        The picture file name, None if there was nothing to draw
+    """
+    if not heatmap:
+        micemsgs = simplify_micemsgs(micemsgs, simplify, output_filename)
+    with stage('rendering') as recorder:
+        if heatmap:
+            fig, ax = heatmap_micemsgs(micemsgs, position)
+        else:
+            fig, ax = handle_micemsgs(micemsgs, position, MICE_COLORS, MICE_ALPHAS)
+        recorder.add(len(micemsgs))
+    if not ax.has_data():
+        return None
+    with stage('savefig'):
+        fig.savefig(output_filename)
+    return output_filename
+
 @click.command()
 @click.option('-d', '--debug', is_flag=True, default=False, help='Enable debug information')
 @click.option('-l', '--left', 'position', flag_value=MICE_STATUS_FLAGS[MiceStatus.LEFT_PRESSED], multiple=True, help='Extract mouse left button data')
 @click.option('-r', '--right', 'position', flag_value=MICE_STATUS_FLAGS[MiceStatus.RIGHT_PRESSED], multiple=True, help='Extract mouse right button data')
 @click.option('-t', '--trace', 'position', flag_value=MICE_STATUS_FLAGS[MiceStatus.MOVE], multiple=True, help='Extract mouse trace data')
+@click.option('--heatmap', is_flag=True, default=False, help='Draw a density heatmap instead of lines')
+@click.option('--simplify', 'tolerance', type=click.FloatRange(min=0), default=0.0, help='Drop points closer than this to the drawn lines, keeping button transitions')
+@click.option('--point-budget', type=click.IntRange(min=2), default=None, help='Aim to draw at most this many points per device, the points around status transitions are always kept')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1, show_default=True, help='Worker processes extracting the capture, decoding and rendering devices concurrently')
+@click.option('-i', '--incremental', is_flag=True, default=False, help='Only decode the packets appended since the last incremental run')
 @click.pass_context
-def parse(ctx: click.Context, position: tuple[str], debug: bool):
+def parse(ctx: click.Context, position: tuple[str], debug: bool, heatmap: bool, tolerance: float, point_budget: Optional[int],
+          jobs: int, incremental: bool):
     # Default position
     if not position:
         position = ('left', )
-    filepath = ctx.obj['filepath']
-    tmppath = ctx.obj['tmppath']
+
+    if incremental:
+        incremental_parse(ctx, position, debug, heatmap, (tolerance, point_budget), jobs)
+        return
+
     filehash = ctx.obj['filehash']
-    colors = ('c', 'r', 'b')
-    alphas = (0.5, 1, 1)
-
-    with open(tmppath, 'w') as tmpio:
-        for filter_param in CAPTURE_FILTER_PARAMS:
-            layers = get_layers(filepath, filter_param, debug)
-
-            ### DEBUG
-            if debug:
-                tmpio.write(json.dumps(layers) + '\n')
-                debug_echo(f'Traffic outputs saved in {tmppath}')
-
-            hiddata_mapping = defaultdict(list)
-            for layer_pkt in layers:
-                layer_pkt: dict
-                # Get usb packet
-                device_id: int = layer_pkt['usb']['usb.src']
-                # Get usb hid-data
-                hid_data: bytes = layer_pkt[filter_param]
-
-                # hid_data convert
-                hid_data = unhexlify(hid_data)
-                hiddata_mapping[device_id].append(hid_data)
-
-            # Generate output information based on hid-data
-            for device_id, hiddatas in hiddata_mapping.items():
-                micemsgs = micemsg_from_hiddata(hiddatas, debug)
-                fig, ax = handle_micemsgs(micemsgs, position, colors, alphas)
-                output_filename = f'{filehash}-{device_id}.png'
-                if ax.has_data():
-                    fig.savefig(output_filename)
-                    success_echo(f'Output saved in ./{output_filename}')
-            
\ No newline at end of file
+    hiddata_mapping = get_plugin_hiddata_mapping(ctx.obj, REPORT_KIND, debug, jobs)
+
+    ### DEBUG
+    if debug:
+        tmppath = ctx.obj['tmppath']
+        with open(tmppath, 'w') as tmpio:
+            tmpio.write(json.dumps({device_id: [hexlify(hid_data) for hid_data in hiddatas]
+                                    for device_id, hiddatas in hiddata_mapping.items()}) + '\n')
+            debug_echo(f'Traffic outputs saved in {tmppath}')
+
+    # Generate output information based on hid-data, the pictures are reported in device order
+    with stage('devices') as recorder:
+        devices = [(device_id, hiddatas, position, heatmap, filehash, (tolerance, point_budget), debug)
+                   for device_id, hiddatas in hiddata_mapping.items()]
+        for output_filename in parallel_echo_map(render_device, devices, jobs):
+            if output_filename is not None:
+                success_echo(f'Output saved in ./{output_filename}')
+            recorder.add()
+
+def incremental_parse(ctx: click.Context, position: tuple[str], debug: bool, heatmap: bool,
+                      simplify: tuple[float, Optional[int]], jobs: int):
+    """
+    Decode the packets appended since the last incremental run and extend the saved trajectories
+    """
+    filepath = ctx.obj['filepath']
+    checkpoint = Checkpoint(ctx.obj['checkpointdir'], filepath, 'mice')
+    _, reader, devices, arrays = checkpoint.load() or (0, None, {}, {})
+    trajectories = {device_id: MiceTrajectory(arrays[f'{device_id}:status'], arrays[f'{device_id}:x'], arrays[f'{device_id}:y'])
+                    for device_id in devices}
+    try:
+        hiddata_mapping, reader = get_new_hiddata_mapping(filepath, reader, debug)
+    except UnsupportedCapture as e:
+        fail_echo(f'{e}, incremental mode is not available')
+        return
+    ### DEBUG
+    if debug:
+        debug_echo(f'Resumed at offset {reader["offset"]} with {len(devices)} known devices')
+
+    with stage('decoding') as recorder:
+        for device_id, hiddatas in hiddata_mapping.items():
+            deltas = deltas_from_hiddata(hiddatas, debug)
+            trajectories[device_id] = (trajectories[device_id].extend(*deltas) if device_id in trajectories
+                                       else MiceTrajectory.from_deltas(*deltas))
+            recorder.add(len(hiddatas))
+    checkpoint.save(reader['offset'], reader, {device_id: len(micemsgs) for device_id, micemsgs in trajectories.items()},
+                    {f'{device_id}:{name}': getattr(micemsgs, name) for device_id, micemsgs in trajectories.items()
+                     for name in MiceTrajectory.__slots__})
+
+    # The content keeps changing, name the pictures after the file instead of its hash
+    filename = ctx.obj['filename']
+    with stage('devices') as recorder:
+        pictures = [(micemsgs, position, heatmap, f'{filename}-{device_id}-heatmap.png' if heatmap else f'{filename}-{device_id}.png', simplify)
+                    for device_id, micemsgs in trajectories.items()]
+        for output_filename in parallel_echo_map(render_trajectory, pictures, jobs):
+            if output_filename is not None:
+                success_echo(f'Output saved in ./{output_filename}')
+            recorder.add()
@@ -1,85 +1,435 @@
-from . import success_echo, fail_echo, debug_echo
-from .utils import unhexlify, hexlify
-from .tsharkutils import get_layers
-from .mice import MiceStatus, MICE_STATUS_FLAGS, MicePosition, MiceMsg, handle_micemsgs
+"""
+Extract mouse traces from a /dev/input/mice log
+"""
+from . import success_echo, fail_echo, fail_echo_many, debug_echo
+from .utils import hexlify
+from .profileutils import stage
+from .mice import MiceStatus, MICE_STATUS_FLAGS, MiceTrajectory, render_trajectory
 import click
-import json
-import matplotlib.pyplot as plt
-from collections import defaultdict
-from typing import NamedTuple
 from enum import IntEnum
-import struct
+from typing import Optional
+import numpy as np
+import math
+import mmap
+import os
+import time
 
 class MiceStatusFlags(IntEnum):
     LEFT_PRESSED = 0x01
     RIGHT_PRESSED = 0x02
     MIDDLE_PRESSED = 0x04
     MOVE = 0x08
+    X_NEGATIVE = 0x10
+    Y_NEGATIVE = 0x20
+    X_OVERFLOW = 0x40
+    Y_OVERFLOW = 0x80
+
+MICELOG_PACKET_DTYPES = {
+    3: np.dtype([('pressed', 'u1'), ('x', 'i1'), ('y', 'i1')]),
+    4: np.dtype([('pressed', 'u1'), ('x', 'i1'), ('y', 'i1'), ('pad', 'V1')]),
+}
+"""
+Layouts of the mice log packets, keyed by packet size
+"""
+
+MICELOG_SAMPLE_BLOCKS = 64
+"""
+Blocks sampled when detecting the packet size and alignment of a mice log
+"""
+
+MICELOG_SAMPLE_BLOCK_SIZE = 4092
+"""
+Bytes per sampled block, a multiple of every packet size
+"""
+
+MICELOG_MIN_SCORE = 0.5
+"""
+Lowest share of plausible packets for a framing to be accepted
+"""
+
+MICELOG_SIGNED_SHARE = 0.9
+"""
+Share of the plausible packets whose sign bits must match their movements for the sign bits to be checked
+"""
+
+MICELOG_RESYNC_PACKETS = 8
+"""
+Implausible packets in a row marking a corrupted region, and plausible ones in a row needed to resynchronize after it
+"""
+
+MICELOG_CHUNK_SIZE = 4 * 1024 * 1024
+"""
+Bytes checked at once while looking for corrupted regions
+"""
+
+FOLLOW_READ_SIZE = 64 * 1024
+"""
+Maximum bytes read at once in follow mode
+"""
+
+FOLLOW_FRAMING_SIZE = MICELOG_SAMPLE_BLOCK_SIZE
+"""
+Bytes buffered in follow mode before detecting the packet size and alignment
+"""
+
+FOLLOW_MAX_POINTS = 1_000_000
+"""
+Default number of most recent points kept in follow mode
+"""
+
+def micelog_deltas(micelog: bytes, packet_size: int):
+    """
+    Decode mice log packets into statuses and relative movements
+
+    Param:
+        micelog: mice log data (any buffer), its length must be a multiple of packet_size
+
+        packet_size: 3 or 4
+
+    Return:
+        status, offset_x, offset_y arrays of the valid packets
+    """
+    packets = np.frombuffer(micelog, dtype=MICELOG_PACKET_DTYPES[packet_size])
+    pressed = packets['pressed']
+    # Left takes priority over right, right over a plain move
+    status = np.select([pressed & MiceStatusFlags.LEFT_PRESSED != 0,
+                        pressed & MiceStatusFlags.RIGHT_PRESSED != 0,
+                        pressed & MiceStatusFlags.MOVE != 0],
+                       [MiceStatus.LEFT_PRESSED, MiceStatus.RIGHT_PRESSED, MiceStatus.MOVE],
+                       default=0xff).astype(np.uint8)
+    valid = status != 0xff
+    fail_echo_many('Unkown data', np.flatnonzero(~valid).tolist(),
+                   lambda i: f'Unkown data: {hexlify(micelog[i * packet_size:(i + 1) * packet_size])}')
+    return status[valid], packets['x'][valid].astype(np.int64), packets['y'][valid].astype(np.int64)
+
+def micelog_plausible(packets: np.ndarray, signed: bool = False):
+    """
+    Whether packets look like the ones written by the mousedev driver
+
+    The fourth bit of the flag byte is always set and the overflow bits never
+    are, the sign bits follow the movements.
+
+    Param:
+        packets: N x packet_size uint8 array
+
+        signed: also check the sign bits
+
+    Return:
+        bool array
+    """
+    flags = packets[:, 0]
+    plausible = (flags & MiceStatusFlags.MOVE != 0) & (flags & (MiceStatusFlags.X_OVERFLOW | MiceStatusFlags.Y_OVERFLOW) == 0)
+    if signed:
+        plausible &= (flags & MiceStatusFlags.X_NEGATIVE != 0) == (packets[:, 1] >= 0x80)
+        plausible &= (flags & MiceStatusFlags.Y_NEGATIVE != 0) == (packets[:, 2] >= 0x80)
+    return plausible
+
+def micelog_framing(micelog: bytes):
+    """
+    Detect the packet size and alignment of a mice log from evenly spaced sampled blocks
+
+    Every candidate is scored by the share of plausible packets it frames,
+    ties are broken by the share whose sign bits also match.
+
+    Param:
+        micelog: mice log data (any buffer), only the sampled blocks are read
+
+    Return:
+        (packet_size, phase, score, signed) phase is the offset of the first
+        packet and signed whether the sign bits can be checked
+    """
+    data = np.frombuffer(micelog, dtype=np.uint8)
+    if len(data) <= MICELOG_SAMPLE_BLOCKS * MICELOG_SAMPLE_BLOCK_SIZE:
+        blocks = data[None, :]
+    else:
+        # Block starts are multiples of every packet size, so a phase means the same in every block
+        period = math.lcm(*MICELOG_PACKET_DTYPES)
+        starts = np.linspace(0, len(data) - MICELOG_SAMPLE_BLOCK_SIZE, MICELOG_SAMPLE_BLOCKS).astype(np.int64) // period * period
+        blocks = data[starts[:, None] + np.arange(MICELOG_SAMPLE_BLOCK_SIZE)]
+    best = (0, 0, 0.0, 0.0)
+    for packet_size in MICELOG_PACKET_DTYPES:
+        for phase in range(packet_size):
+            count = (blocks.shape[1] - phase) // packet_size
+            if count == 0:
+                continue
+            packets = blocks[:, phase:phase + count * packet_size].reshape(-1, packet_size)
+            plausible = np.count_nonzero(micelog_plausible(packets)) / len(packets)
+            signed = np.count_nonzero(micelog_plausible(packets, True)) / len(packets)
+            if (plausible, signed) > best[2:]:
+                best = (packet_size, phase, plausible, signed)
+    packet_size, phase, plausible, signed = best
+    return packet_size, phase, float(plausible), bool(plausible > 0 and signed >= MICELOG_SIGNED_SHARE * plausible)
+
+def micelog_resync(data: np.ndarray, offset: int, packet_size: int, signed: bool = False):
+    """
+    Find where consistently framed packets start again after a corrupted region
+
+    Param:
+        data: mice log bytes
+
+        offset: first byte that may start a packet
+
+        packet_size: 3 or 4
+
+        signed: also check the sign bits
+
+    Return:
+        Offset of the first of MICELOG_RESYNC_PACKETS plausible packets in a row, None if there is none
+    """
+    span = MICELOG_RESYNC_PACKETS * packet_size
+    while offset + span <= len(data):
+        end = min(len(data), offset + MICELOG_CHUNK_SIZE)
+        # A packet starting at every byte of the chunk
+        plausible = micelog_plausible(np.lib.stride_tricks.sliding_window_view(data[offset:end], packet_size), signed)
+        count = len(plausible) - span + packet_size
+        if count > 0:
+            resynced = plausible[:count].copy()
+            for i in range(packet_size, span, packet_size):
+                resynced &= plausible[i:i + count]
+            hits = np.flatnonzero(resynced)
+            if hits.size:
+                return offset + int(hits[0])
+        # Runs crossing the end of the chunk are checked again in the next one
+        offset = max(end - span + 1, offset + 1)
+    return None
+
+def micelog_segments(micelog: bytes, packet_size: int, phase: int, signed: bool = False):
+    """
+    Split a mice log into consistently framed runs of packets, resynchronizing after corrupted regions
+
+    Param:
+        micelog: mice log data (any buffer)
+
+        packet_size: 3 or 4
+
+        phase: offset of the first packet
+
+        signed: also check the sign bits
+
+    Return:
+        A list of (start, end) byte offsets, every run holds whole packets
+    """
+    data = np.frombuffer(micelog, dtype=np.uint8)
+    segments = []
+    start = offset = phase
+    while True:
+        count = min(len(data) - offset, MICELOG_CHUNK_SIZE) // packet_size
+        if count < MICELOG_RESYNC_PACKETS:
+            break
+        plausible = micelog_plausible(data[offset:offset + count * packet_size].reshape(count, packet_size), signed)
+        # Runs of implausible packets, from the few implausible ones of a clean log
+        implausible = np.flatnonzero(~plausible)
+        corrupted = implausible[np.flatnonzero(implausible[MICELOG_RESYNC_PACKETS - 1:] - implausible[:len(implausible) - MICELOG_RESYNC_PACKETS + 1]
+                                               == MICELOG_RESYNC_PACKETS - 1)]
+        if not corrupted.size:
+            # The last packets may begin a corrupted region going on in the next chunk
+            offset += (count - MICELOG_RESYNC_PACKETS + 1) * packet_size
+            continue
+        end = offset + int(corrupted[0]) * packet_size
+        if end > start:
+            segments.append((start, end))
+            first = end + 1
+        else:
+            # The log starts at another phase than the detected one, try every phase from its beginning
+            end = first = 0
+        resync = micelog_resync(data, first, packet_size, signed)
+        if resync is None or resync > end:
+            fail_echo(f'Skipped corrupted data from offset {end} to {len(data) if resync is None else resync}', reason='Skipped corrupted data')
+        if resync is None:
+            return segments
+        start = offset = resync
+    end = offset + count * packet_size
+    if end > start:
+        segments.append((start, end))
+    return segments
 
 def micemsg_from_micelog(micelog: bytes, debug: bool = False):
     """
-    Generate mice message from hid-data
+    Generate mice message from mice log
+
+    The packet size and alignment are detected from the contents rather than
+    the length of the log, corrupted regions are skipped.
 
     Param:
-        hiddatas: hid-datas, such as [b'\\x00\\x00\\x02\\x00\\x00\\x00\\x00\\x00']
+        micelog: mice log data (bytes or any buffer such as mmap), such as b'\\x08\\x02\\x00\\x09\\x00\\x00'
         
         debug: Whether to output debugging information, False is default
     
     Return:
-        A list containing parsed mice message(MiceMsg)
+        A MiceTrajectory containing parsed mice message
     """
-
-    if len(micelog) % 3 == 0:
-        data_section = [micelog[i:i+3] for i in range(0, len(micelog), 3)]
-    elif len(micelog) % 4 == 0:
-        data_section = [micelog[i:i+4] for i in range(0, len(micelog), 4)]
-    else:
+    empty = MiceTrajectory.from_deltas(np.empty(0, np.uint8), np.empty(0, np.int64), np.empty(0, np.int64))
+    if len(micelog) == 0:
+        return empty
+    with stage('framing'):
+        packet_size, phase, score, signed = micelog_framing(micelog)
+    ### DEBUG
+    if debug:
+        debug_echo(f'Detected {packet_size}-byte packets from offset {phase}, {score:.1%} plausible, sign bits {"checked" if signed else "ignored"}')
+    if score < MICELOG_MIN_SCORE:
         fail_echo('Could not parse this mice log')
-    position = MicePosition(0, 0)
-    micemsg: list[MiceMsg] = [MiceMsg(MiceStatus.MOVE, position)]
-    for data in data_section:
-        if len(data) == 3:
-            pressed, offset_x, offset_y = struct.unpack('Bbb', data)
-        elif len(data) == 4:
-            pressed, offset_x, offset_y = struct.unpack('Bbbx', data)
-        else:
-            fail_echo(f'Unkown data: {hexlify(data)}')
-            continue
-        if pressed & MiceStatusFlags.LEFT_PRESSED:
-            status = MiceStatus.LEFT_PRESSED
-        elif pressed & MiceStatusFlags.RIGHT_PRESSED:
-            status = MiceStatus.RIGHT_PRESSED
-        elif pressed & MiceStatusFlags.MOVE:
-            status = MiceStatus.MOVE
-        else:
-            fail_echo(f'Unkown data: {hexlify(data)}')
-            continue
-        position = MicePosition(position.x + offset_x, position.y + offset_y)
-        micemsg.append(MiceMsg(status, position))
-    return micemsg
+        return empty
+    segments = micelog_segments(micelog, packet_size, phase, signed)
+    view = memoryview(micelog)
+    deltas = [micelog_deltas(view[start:end], packet_size) for start, end in segments]
+    if not deltas:
+        return empty
+    if len(deltas) == 1:
+        return MiceTrajectory.from_deltas(*deltas[0])
+    return MiceTrajectory.from_deltas(*map(np.concatenate, zip(*deltas)))
+
+def micemsg_from_micelog_file(filepath: str, debug: bool = False):
+    """
+    Generate mice message from a mice log file without reading it into memory
+
+    Param:
+        filepath: mice log file path
+
+        debug: Whether to output debugging information, False is default
+
+    Return:
+        A MiceTrajectory containing parsed mice message
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return micemsg_from_micelog(b'', debug)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as micelog:
+            return micemsg_from_micelog(micelog, debug)
+
+class MicelogFollower:
+    """
+    Incremental decoder of a growing mice log.
+
+    Without a packet size, the packet size and alignment are detected from the
+    first `FOLLOW_FRAMING_SIZE` bytes that look like a mice log.
+    Only the `max_points` most recent points are kept.
+    """
+
+    def __init__(self, packet_size: Optional[int] = None, max_points: int = FOLLOW_MAX_POINTS):
+        self.packet_size = packet_size
+        self.max_points = max_points
+        self.pending = b''
+        self.trajectory = MiceTrajectory.from_deltas(np.empty(0, np.uint8), np.empty(0, np.int64), np.empty(0, np.int64))
+
+    def detect(self):
+        """
+        Detect the packet size and alignment from the first `FOLLOW_FRAMING_SIZE` buffered bytes,
+        only the bytes before the first packet are dropped
+
+        Returns:
+            (packet_size, phase, score, signed), None if the buffered data does not look like a mice log
+        """
+        framing = micelog_framing(self.pending[:FOLLOW_FRAMING_SIZE])
+        packet_size, phase, score, _ = framing
+        if score < MICELOG_MIN_SCORE:
+            return None
+        self.packet_size = packet_size
+        self.pending = self.pending[phase:]
+        return framing
+
+    def feed(self, data: bytes):
+        """
+        Decode newly appended data
+
+        Param:
+            data - appended bytes, a trailing partial packet is kept for the next call
+
+        Returns:
+            Number of decoded packets
+        """
+        data = self.pending + data
+        if self.packet_size is None:
+            self.pending = data
+            # Slide over the leading blocks that do not frame as a mice log
+            while len(self.pending) >= FOLLOW_FRAMING_SIZE and self.detect() is None:
+                self.pending = self.pending[FOLLOW_FRAMING_SIZE:]
+            if self.packet_size is None:
+                return 0
+            data = self.pending
+        size = len(data) - len(data) % self.packet_size
+        self.pending = data[size:]
+        if size == 0:
+            return 0
+        status, offset_x, offset_y = micelog_deltas(data[:size], self.packet_size)
+        trajectory = self.trajectory.extend(status, offset_x, offset_y)
+        self.trajectory = MiceTrajectory(trajectory.status[-self.max_points:], trajectory.x[-self.max_points:],
+                                         trajectory.y[-self.max_points:])
+        return len(status)
+
+def follow_micelog(filepath: str, position: tuple, heatmap: bool, output_filename: str,
+                   packet_size: Optional[int], interval: float, max_points: int,
+                   simplify: tuple[float, Optional[int]] = (0.0, None), debug: bool = False):
+    """
+    Decode a mice log as it grows and refresh the picture every `interval` seconds, until interrupted
+
+    The packet size and alignment are detected from the first data unless `packet_size` is given.
+    """
+    follower = MicelogFollower(packet_size, max_points)
+    fd = os.open(filepath, os.O_RDONLY)
+    rendered = 0
+    last_render = time.monotonic()
+    try:
+        while True:
+            data = os.read(fd, FOLLOW_READ_SIZE)
+            detecting = follower.packet_size is None
+            if data:
+                follower.feed(data)
+            elif detecting and follower.pending and follower.detect() is not None:
+                # Caught up with a log shorter than a framing block, frame what is there
+                follower.feed(b'')
+            elif len(follower.trajectory) == rendered:
+                time.sleep(interval)
+            ### DEBUG
+            if debug and detecting and follower.packet_size is not None:
+                debug_echo(f'Detected {follower.packet_size}-byte packets')
+            if len(follower.trajectory) != rendered and time.monotonic() - last_render >= interval:
+                last_render = time.monotonic()
+                rendered = len(follower.trajectory)
+                if render_trajectory(follower.trajectory, position, heatmap, output_filename, simplify):
+                    ### DEBUG
+                    if debug:
+                        debug_echo(f'Output updated in ./{output_filename}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(fd)
+    if render_trajectory(follower.trajectory, position, heatmap, output_filename, simplify):
+        success_echo(f'Output saved in ./{output_filename}')
 
 @click.command()
 @click.option('-d', '--debug', is_flag=True, default=False, help='Enable debug information')
 @click.option('-l', '--left', 'position', flag_value=MICE_STATUS_FLAGS[MiceStatus.LEFT_PRESSED], multiple=True, help='Extract mouse left button data')
 @click.option('-r', '--right', 'position', flag_value=MICE_STATUS_FLAGS[MiceStatus.RIGHT_PRESSED], multiple=True, help='Extract mouse right button data')
 @click.option('-t', '--trace', 'position', flag_value=MICE_STATUS_FLAGS[MiceStatus.MOVE], multiple=True, help='Extract mouse trace data')
+@click.option('--heatmap', is_flag=True, default=False, help='Draw a density heatmap instead of lines')
+@click.option('-F', '--follow', is_flag=True, default=False, help='Keep decoding data appended to the log until interrupted')
+@click.option('--packet-size', type=click.Choice(['3', '4']), default=None, help='Packet size in follow mode, detected from the first data by default')
+@click.option('--interval', type=float, default=1.0, show_default=True, help='Seconds between picture updates in follow mode')
+@click.option('--max-points', type=click.IntRange(min=1), default=FOLLOW_MAX_POINTS, show_default=True, help='Most recent points kept in follow mode')
+@click.option('--simplify', 'tolerance', type=click.FloatRange(min=0), default=0.0, help='Drop points closer than this to the drawn lines, keeping button transitions')
+@click.option('--point-budget', type=click.IntRange(min=2), default=None, help='Aim to draw at most this many points, the points around status transitions are always kept')
 @click.pass_context
-def parse(ctx: click.Context, position: tuple[str], debug: bool):
+def parse(ctx: click.Context, position: tuple[str], debug: bool, heatmap: bool, follow: bool,
+          packet_size: Optional[str], interval: float, max_points: int, tolerance: float, point_budget: Optional[int]):
     # Default position
     if not position:
         position = ('left', )
     filepath = ctx.obj['filepath']
-    tmppath = ctx.obj['tmppath']
-    filehash = ctx.obj['filehash']
-    colors = ('c', 'r', 'b')
-    alphas = (0.5, 1, 1)
 
-    with open(filepath, 'rb') as f:
-        micelog = f.read()
-    micemsgs = micemsg_from_micelog(micelog, debug)
-    print(micemsgs)
-    fig, ax = handle_micemsgs(micemsgs, position, colors, alphas)
-    output_filename = f'{filehash}.png'
-    if ax.has_data():
-        fig.savefig(output_filename)
-        success_echo(f'Output saved in ./{output_filename}')
\ No newline at end of file
+    if follow:
+        # The content keeps changing, name the picture after the file instead of its hash
+        output_filename = f'{ctx.obj["filename"]}-heatmap.png' if heatmap else f'{ctx.obj["filename"]}.png'
+        follow_micelog(filepath, position, heatmap, output_filename, int(packet_size) if packet_size else None, interval, max_points,
+                       (tolerance, point_budget), debug)
+        return
+
+    filehash = ctx.obj['filehash']
+    with stage('decoding') as recorder:
+        micemsgs = micemsg_from_micelog_file(filepath, debug)
+        recorder.add(len(micemsgs) - 1)
+    ### DEBUG
+    if debug:
+        debug_echo(f'Parsed {len(micemsgs) - 1} mice messages')
+    output_filename = f'{filehash}-heatmap.png' if heatmap else f'{filehash}.png'
+    if render_trajectory(micemsgs, position, heatmap, output_filename, (tolerance, point_budget)):
+        success_echo(f'Output saved in ./{output_filename}')
@@ -0,0 +1,430 @@
+from . import debug_echo
+from typing import NamedTuple, BinaryIO, Optional
+import os
+import struct
+
+LINKTYPE_USB_LINUX = 189
+"""
+Linux usbmon link type (48-byte header)
+"""
+
+LINKTYPE_USB_LINUX_MMAPPED = 220
+"""
+Linux usbmon link type (64-byte header)
+"""
+
+LINKTYPE_USBPCAP = 249
+"""
+Windows USBPcap link type
+"""
+
+SUPPORTED_LINKTYPES = (LINKTYPE_USB_LINUX, LINKTYPE_USB_LINUX_MMAPPED, LINKTYPE_USBPCAP, )
+"""
+Link types that can be read without tshark
+"""
+
+PCAP_MAGICS = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+"""
+pcap magic numbers mapping to (byte order, timestamp resolution)
+"""
+
+PCAPNG_SHB_TYPE = 0x0A0D0D0A
+"""
+pcapng Section Header Block type
+"""
+
+PCAPNG_IDB_TYPE = 0x00000001
+"""
+pcapng Interface Description Block type
+"""
+
+PCAPNG_PB_TYPE = 0x00000002
+"""
+pcapng (obsolete) Packet Block type
+"""
+
+PCAPNG_SPB_TYPE = 0x00000003
+"""
+pcapng Simple Packet Block type
+"""
+
+PCAPNG_EPB_TYPE = 0x00000006
+"""
+pcapng Enhanced Packet Block type
+"""
+
+USB_TRANSFER_INTERRUPT = 0x01
+"""
+USB interrupt transfer type, the only one carrying HID reports (bulk, isochronous and control payloads are dropped)
+"""
+
+class UnsupportedCapture(Exception):
+    """
+    The capture file (or one of its link types) can not be read natively
+    """
+
+class UsbReport(NamedTuple):
+    timestamp: float
+    device_id: str
+    data: bytes
+
+class UsbInterface(NamedTuple):
+    linktype: int
+    tsresol: float
+
+def usb_report_from_usbmon(packet: bytes, endian: str, header_size: int):
+    """
+    Parse a Linux usbmon packet
+
+    Param:
+        packet - packet data with usbmon header
+
+        endian - byte order of the header
+
+        header_size - 48 or 64
+
+    Returns:
+        (device_id, payload), device_id is None if the packet carries no report
+    """
+    if len(packet) < header_size:
+        return None, b''
+    (event_type, transfer_type, endpoint, device, bus,
+     len_cap) = struct.unpack_from(f'{endian}8xcBBBH22xI', packet)
+    if transfer_type != USB_TRANSFER_INTERRUPT or len_cap == 0:
+        return None, b''
+    # Submissions come from the host, completions from the device
+    device_id = 'host' if event_type == b'S' else f'{bus}.{device}.{endpoint & 0x7f}'
+    return device_id, packet[header_size:header_size + len_cap]
+
+def usb_report_from_usbpcap(packet: bytes):
+    """
+    Parse a USBPcap packet
+
+    Param:
+        packet - packet data with USBPcap header
+
+    Returns:
+        (device_id, payload), device_id is None if the packet carries no report
+    """
+    if len(packet) < 27:
+        return None, b''
+    (header_len, info, bus, device, endpoint, transfer_type,
+     data_len) = struct.unpack_from('<H14xBHHBBI', packet)
+    if transfer_type != USB_TRANSFER_INTERRUPT or data_len == 0:
+        return None, b''
+    # PDO -> FDO means the IRP is on its way back from the device
+    device_id = f'{bus}.{device}.{endpoint & 0x0f}' if info & 0x01 else 'host'
+    return device_id, packet[header_len:header_len + data_len]
+
+def usb_report_from_packet(packet: bytes, linktype: int, endian: str = '<'):
+    """
+    Parse a packet of any supported USB link type
+
+    Param:
+        packet - packet data
+
+        linktype - link type of the interface
+
+        endian - byte order of the capture file
+
+    Returns:
+        (device_id, payload), device_id is None if the packet carries no report
+    """
+    if linktype == LINKTYPE_USBPCAP:
+        return usb_report_from_usbpcap(packet)
+    elif linktype == LINKTYPE_USB_LINUX:
+        return usb_report_from_usbmon(packet, endian, 48)
+    elif linktype == LINKTYPE_USB_LINUX_MMAPPED:
+        return usb_report_from_usbmon(packet, endian, 64)
+    raise UnsupportedCapture(f'Unsupported link type: {linktype}')
+
+class UsbCaptureReader:
+    """
+    Streaming pcap/pcapng reader yielding USB reports.
+
+    Only the block headers and the packet being parsed are held in memory.
+    `offset` is the file offset right after the last complete block that was read,
+    `state()` saves it with the pcapng section state so a later reader can
+    resume there once the file has grown. Reading stops at the first block
+    starting at or after `end`, if given.
+    """
+
+    def __init__(self, filepath: str, debug: bool = False, state: Optional[dict] = None, end: Optional[int] = None):
+        self.filepath = filepath
+        self.debug = debug
+        self.end = end
+        self.offset = 0
+        self.endian = '<'
+        self.interfaces: list[UsbInterface] = []
+        # Offset of the last pcapng section header or interface description block read
+        self.header_offset = -1
+        if state is not None:
+            self.offset = state['offset']
+            self.endian = state['endian']
+            self.interfaces = [UsbInterface(*interface) for interface in state['interfaces']]
+
+    def state(self):
+        """
+        JSON-serializable position of the reader, to resume with `UsbCaptureReader(filepath, state=...)`
+        """
+        return dict(offset=self.offset, endian=self.endian, interfaces=[list(interface) for interface in self.interfaces])
+
+    def __iter__(self):
+        with open(self.filepath, 'rb') as f:
+            magic = f.read(4)
+            f.seek(0)
+            if magic in PCAP_MAGICS:
+                yield from self._iter_pcap(f)
+            elif len(magic) == 4 and struct.unpack('<I', magic)[0] == PCAPNG_SHB_TYPE:
+                yield from self._iter_pcapng(f)
+            else:
+                raise UnsupportedCapture(f'Unknown capture format: {magic.hex()}')
+
+    def _iter_pcap(self, f: BinaryIO):
+        header = f.read(24)
+        endian, tsresol = PCAP_MAGICS[header[:4]]
+        linktype = struct.unpack_from(f'{endian}I', header, 20)[0] & 0x0fffffff
+        if linktype not in SUPPORTED_LINKTYPES:
+            raise UnsupportedCapture(f'Unsupported link type: {linktype}')
+        ### DEBUG
+        if self.debug:
+            debug_echo(f'Native pcap reader, link type: {linktype}')
+        if self.offset:
+            f.seek(self.offset)
+        else:
+            self.offset = f.tell()
+        record_header = struct.Struct(f'{endian}IIII')
+        while self.end is None or self.offset < self.end:
+            head = f.read(16)
+            if len(head) < 16:
+                return
+            ts_sec, ts_frac, caplen, _ = record_header.unpack(head)
+            packet = f.read(caplen)
+            if len(packet) < caplen:
+                return
+            self.offset += 16 + caplen
+            device_id, data = usb_report_from_packet(packet, linktype, endian)
+            if device_id is not None:
+                yield UsbReport(ts_sec + ts_frac * tsresol, device_id, data)
+
+    def _iter_pcapng(self, f: BinaryIO):
+        f.seek(self.offset)
+        while self.end is None or self.offset < self.end:
+            head = f.read(8)
+            if len(head) < 8:
+                return
+            block_type = struct.unpack_from('<I', head)[0]
+            if block_type == PCAPNG_SHB_TYPE:
+                # A new section may switch the byte order and resets the interfaces
+                byte_order = f.read(4)
+                self.endian = '<' if byte_order == b'\x4d\x3c\x2b\x1a' else '>'
+                self.interfaces = []
+                block_len = struct.unpack_from(f'{self.endian}I', head, 4)[0]
+                body = byte_order + f.read(block_len - 12)
+            else:
+                block_type, block_len = struct.unpack(f'{self.endian}II', head)
+                body = f.read(block_len - 8)
+            if block_len < 12 or len(body) < block_len - 8:
+                return
+            if block_type in (PCAPNG_SHB_TYPE, PCAPNG_IDB_TYPE):
+                self.header_offset = self.offset
+            self.offset += block_len
+            if block_type == PCAPNG_IDB_TYPE:
+                self.interfaces.append(self._parse_idb(body, self.endian))
+                continue
+            if block_type == PCAPNG_EPB_TYPE:
+                iface_id, ts_high, ts_low, caplen = struct.unpack_from(f'{self.endian}IIII', body)
+                packet = body[20:20 + caplen]
+            elif block_type == PCAPNG_PB_TYPE:
+                iface_id, _, ts_high, ts_low, caplen = struct.unpack_from(f'{self.endian}HHIII', body)
+                packet = body[20:20 + caplen]
+            elif block_type == PCAPNG_SPB_TYPE:
+                # Simple packets have no timestamp and always belong to the first interface
+                iface_id, ts_high, ts_low = 0, 0, 0
+                origlen = struct.unpack_from(f'{self.endian}I', body)[0]
+                packet = body[4:4 + min(origlen, len(body) - 8)]
+            else:
+                continue
+            interface = self.interfaces[iface_id]
+            device_id, data = usb_report_from_packet(packet, interface.linktype, self.endian)
+            if device_id is not None:
+                yield UsbReport(((ts_high << 32) | ts_low) * interface.tsresol, device_id, data)
+
+    def _read_pcapng_headers(self, f: BinaryIO):
+        """
+        Read the leading section header and interface description blocks, stopping before the first other block
+        """
+        f.seek(self.offset)
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                return
+            block_type = struct.unpack_from('<I', head)[0]
+            if block_type == PCAPNG_SHB_TYPE:
+                byte_order = f.read(4)
+                self.endian = '<' if byte_order == b'\x4d\x3c\x2b\x1a' else '>'
+                self.interfaces = []
+                block_len = struct.unpack_from(f'{self.endian}I', head, 4)[0]
+                f.seek(block_len - 12, os.SEEK_CUR)
+            elif struct.unpack_from(f'{self.endian}I', head)[0] == PCAPNG_IDB_TYPE:
+                block_len = struct.unpack_from(f'{self.endian}I', head, 4)[0]
+                self.interfaces.append(self._parse_idb(f.read(block_len - 8), self.endian))
+            else:
+                return
+            self.offset += block_len
+
+    def _parse_idb(self, body: bytes, endian: str):
+        linktype = struct.unpack_from(f'{endian}H', body)[0]
+        if linktype not in SUPPORTED_LINKTYPES:
+            raise UnsupportedCapture(f'Unsupported link type: {linktype}')
+        ### DEBUG
+        if self.debug:
+            debug_echo(f'Native pcapng reader, link type: {linktype}')
+        tsresol = 1e-6
+        # Walk the options looking for if_tsresol
+        pos = 8
+        while pos + 4 <= len(body) - 4:
+            code, length = struct.unpack_from(f'{endian}HH', body, pos)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                value = body[pos + 4]
+                tsresol = 2.0 ** -(value & 0x7f) if value & 0x80 else 10.0 ** -value
+            pos += 4 + (length + 3) // 4 * 4
+        return UsbInterface(linktype, tsresol)
+
+SHARD_SYNC_WINDOW = 4 * 1024 * 1024
+"""
+Bytes searched for a block boundary after a shard split point
+"""
+
+SHARD_SYNC_BLOCKS = 8
+"""
+Consecutive well-formed blocks required to accept a block boundary
+"""
+
+PCAPNG_BLOCK_TYPES = (PCAPNG_SHB_TYPE, PCAPNG_IDB_TYPE, PCAPNG_PB_TYPE, PCAPNG_SPB_TYPE, 0x00000004, 0x00000005, PCAPNG_EPB_TYPE)
+"""
+pcapng block types a shard may start with (the standard ones)
+"""
+
+def pcap_record_end(buf: bytes, pos: int, endian: str, snaplen: int, frac_limit: int, ts_range: tuple[int, int]):
+    """
+    End of the pcap record at `pos` if its header is plausible, else None
+    """
+    if pos + 16 > len(buf):
+        return None
+    ts_sec, ts_frac, caplen, origlen = struct.unpack_from(f'{endian}IIII', buf, pos)
+    if caplen > snaplen or caplen > origlen or ts_frac >= frac_limit or not ts_range[0] <= ts_sec <= ts_range[1]:
+        return None
+    return pos + 16 + caplen
+
+def pcapng_block_end(buf: bytes, pos: int, endian: str):
+    """
+    End of the pcapng block at `pos` if it is well-formed, else None
+    """
+    if pos + 12 > len(buf):
+        return None
+    block_type, block_len = struct.unpack_from(f'{endian}II', buf, pos)
+    if block_type not in PCAPNG_BLOCK_TYPES or block_len < 12 or block_len % 4 or pos + block_len > len(buf):
+        return None
+    if struct.unpack_from(f'{endian}I', buf, pos + block_len - 4)[0] != block_len:
+        return None
+    return pos + block_len
+
+def find_block_boundary(f: BinaryIO, offset: int, size: int, block_end, align: int = 1):
+    """
+    Find the first block boundary at or after `offset`.
+
+    A position is a boundary when SHARD_SYNC_BLOCKS well-formed blocks
+    follow it back to back (or fewer ending exactly at the end of the file).
+
+    Param:
+        f - capture file
+
+        offset - where to start searching
+
+        size - file size
+
+        block_end - function (buffer, position) returning the end of a plausible block there, or None
+
+        align - blocks only start at multiples of it
+
+    Returns:
+        The boundary offset, None if none was found within SHARD_SYNC_WINDOW bytes
+    """
+    f.seek(offset)
+    buf = f.read(SHARD_SYNC_WINDOW)
+    at_eof = offset + len(buf) >= size
+    for start in range(-offset % align, len(buf), align):
+        pos = start
+        for _ in range(SHARD_SYNC_BLOCKS):
+            pos = block_end(buf, pos)
+            if pos is None or (pos == len(buf) and at_eof):
+                break
+        if pos is not None:
+            return offset + start
+    return None
+
+def shard_capture(filepath: str, shards: int):
+    """
+    Split a capture into packet ranges that can be read independently
+
+    Param:
+        filepath - capture file path
+
+        shards - wanted number of shards
+
+    Returns:
+        (ranges, header_end) a list of (reader state, end offset) in file order, to be read with
+        `UsbCaptureReader(filepath, state=..., end=...)`, and the end of the leading pcapng
+        header blocks (the shards are only valid if no such block appears after it)
+
+    Raises:
+        UnsupportedCapture - the capture can not be read natively
+    """
+    size = os.path.getsize(filepath)
+    reader = UsbCaptureReader(filepath)
+    with open(filepath, 'rb') as f:
+        magic = f.read(4)
+        f.seek(0)
+        if magic in PCAP_MAGICS:
+            header = f.read(24)
+            endian, tsresol = PCAP_MAGICS[header[:4]]
+            snaplen, linktype = struct.unpack_from(f'{endian}II', header, 16)
+            if linktype & 0x0fffffff not in SUPPORTED_LINKTYPES:
+                raise UnsupportedCapture(f'Unsupported link type: {linktype & 0x0fffffff}')
+            first = f.read(16)
+            ts_first = struct.unpack_from(f'{endian}I', first)[0] if len(first) == 16 else 0
+            frac_limit = 10 ** 6 if tsresol == 1e-6 else 10 ** 9
+            # Records are assumed to be at most a day older and a year newer than the first one
+            ts_range = (max(ts_first - 86400, 0), ts_first + 86400 * 365)
+            block_end = lambda buf, pos: pcap_record_end(buf, pos, endian, max(snaplen, 0xffff), frac_limit, ts_range)
+            align = 1
+            header_end = first_block = 24
+        elif len(magic) == 4 and struct.unpack('<I', magic)[0] == PCAPNG_SHB_TYPE:
+            # Read the leading header blocks, every shard starts with the interfaces they describe
+            reader._read_pcapng_headers(f)
+            header_end = reader.offset
+            endian = reader.endian
+            block_end = lambda buf, pos: pcapng_block_end(buf, pos, endian)
+            align = 4
+            first_block = header_end
+        else:
+            raise UnsupportedCapture(f'Unknown capture format: {magic.hex()}')
+
+        starts = [first_block]
+        for i in range(1, shards):
+            boundary = find_block_boundary(f, max(size * i // shards, starts[-1] + 1), size, block_end, align)
+            if boundary is not None and boundary > starts[-1]:
+                starts.append(boundary)
+    state = reader.state()
+    ranges = [(dict(state, offset=start), end) for start, end in zip(starts, starts[1:] + [size])]
+    # The first shard reads the file headers itself
+    ranges[0] = (None, ranges[0][1])
+    return ranges, header_end
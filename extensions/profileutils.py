@@ -0,0 +1,232 @@
+"""
+Per-stage profiling of a run.
+
+Plugins declare their stages with the `stage` context manager, which costs
+nothing unless `--profile` is given:
+
+    with stage('decoding') as recorder:
+        keys = keypress_from_hiddata(hiddatas)
+        recorder.add(len(hiddatas))
+
+Stages entered inside another stage are recorded as `outer/inner`.
+"""
+import contextlib
+import json
+import sys
+import time
+from typing import Iterable, Optional
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then left out
+    resource = None
+
+class StageRecorder:
+    """
+    Handle of a running stage, used to count the records it processed
+    """
+    __slots__ = ('records', )
+
+    def __init__(self):
+        self.records = 0
+
+    def add(self, records: int = 1):
+        """
+        Count processed records
+
+        Param:
+            records - number of records
+        """
+        self.records += records
+
+class NullRecorder(StageRecorder):
+    """
+    Recorder handed out when profiling is disabled
+    """
+
+    def add(self, records: int = 1):
+        pass
+
+NULL_RECORDER = NullRecorder()
+"""
+Shared recorder of disabled stages
+"""
+
+def peak_rss():
+    """
+    Peak resident set size (bytes) of this process, None if unknown
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def children_cpu():
+    """
+    CPU time (secs) of the waited-for child processes, such as tshark
+    """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class Profiler:
+    """
+    Collects wall time, CPU time, peak RSS and record counts per stage
+    """
+
+    def __init__(self):
+        self.stages: dict[str, dict] = {}
+        self.path: list[str] = []
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.children_cpu = children_cpu()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        self.path.append(name)
+        fullname = '/'.join(self.path)
+        recorder = StageRecorder()
+        wall, cpu, child = time.perf_counter(), time.process_time(), children_cpu()
+        try:
+            yield recorder
+        finally:
+            stats = self.stages.setdefault(fullname, dict(name=fullname, calls=0, wall=0.0, cpu=0.0,
+                                                          children_cpu=0.0, records=0, peak_rss=None))
+            stats['calls'] += 1
+            stats['wall'] += time.perf_counter() - wall
+            stats['cpu'] += time.process_time() - cpu
+            stats['children_cpu'] += children_cpu() - child
+            stats['records'] += recorder.records
+            stats['peak_rss'] = peak_rss()
+            # A generator may close its stage late, remove its own entry rather than the last one
+            if self.path[-1] == name:
+                self.path.pop()
+            else:
+                self.path.remove(name)
+
+    def merge(self, stages: list[dict]):
+        """
+        Add the stages recorded by another process, nested in the current stage
+
+        Param:
+            stages - `stages` of the other process' report
+        """
+        prefix = ''.join(f'{name}/' for name in self.path)
+        for other in stages:
+            fullname = prefix + other['name']
+            stats = self.stages.setdefault(fullname, dict(other, name=fullname, calls=0, wall=0.0, cpu=0.0,
+                                                          children_cpu=0.0, records=0, peak_rss=None))
+            for key in ('calls', 'wall', 'cpu', 'children_cpu', 'records'):
+                stats[key] += other[key]
+            # Peak RSS of the busiest process
+            stats['peak_rss'] = max(filter(None, (stats['peak_rss'], other['peak_rss'])), default=None)
+
+    def report(self):
+        """
+        The collected metrics as a JSON-serializable dict
+        """
+        return dict(wall=time.perf_counter() - self.wall,
+                    cpu=time.process_time() - self.cpu,
+                    children_cpu=children_cpu() - self.children_cpu,
+                    peak_rss=peak_rss(),
+                    stages=list(self.stages.values()))
+
+PROFILER: Optional[Profiler] = None
+"""
+Profiler of the current run, None when profiling is disabled
+"""
+
+def enable_profiling():
+    """
+    Start profiling with a fresh profiler
+
+    Returns:
+        The profiler
+    """
+    global PROFILER
+    PROFILER = Profiler()
+    return PROFILER
+
+def disable_profiling():
+    """
+    Stop profiling
+
+    Returns:
+        The metrics collected so far, None if profiling was disabled
+    """
+    global PROFILER
+    report = PROFILER.report() if PROFILER is not None else None
+    PROFILER = None
+    return report
+
+def profiling():
+    """
+    Whether the current run is profiled
+    """
+    return PROFILER is not None
+
+def merge_profile(report: Optional[dict]):
+    """
+    Merge the metrics collected by a worker process into the current stage
+
+    Param:
+        report - disable_profiling() result of the worker, None if it did not profile
+    """
+    if PROFILER is not None and report is not None:
+        PROFILER.merge(report['stages'])
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Declare a stage of the run
+
+    Param:
+        name - stage name, such as 'decoding'
+
+    Returns:
+        A context manager giving a StageRecorder
+    """
+    if PROFILER is None:
+        yield NULL_RECORDER
+        return
+    with PROFILER.stage(name) as recorder:
+        yield recorder
+
+def stage_iter(name: str, iterable: Iterable):
+    """
+    Pass items through within a stage, counting each one as a record
+
+    Param:
+        name - stage name
+
+        iterable - items, such as USB reports
+
+    Returns:
+        A generator of the same items
+    """
+    if PROFILER is None:
+        yield from iterable
+        return
+    with stage(name) as recorder:
+        for item in iterable:
+            recorder.add()
+            yield item
+
+def write_profile(report: dict, output: str):
+    """
+    Write metrics as JSON
+
+    Param:
+        report - metrics
+
+        output - file path, '-' for the standard output
+    """
+    text = json.dumps(report, indent=2)
+    if output == '-':
+        sys.stdout.write(text + '\n')
+        return
+    with open(output, 'w') as f:
+        f.write(text + '\n')
@@ -0,0 +1,268 @@
+"""
+Long-lived job server.
+
+Jobs are JSON objects such as
+
+    {"file": "keyboard_test/example.pcap", "plugin": "keyboard", "args": ["-j", "2"], "options": {"samples": 10}}
+
+sent either over HTTP (`POST /jobs`) or one per line over a Unix socket; a
+list of jobs is run concurrently and answered with a list of results.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable
+import http.server
+import importlib
+import json
+import os
+import socketserver
+import stat
+import threading
+
+WARM_MODULES = ('matplotlib.figure', 'matplotlib.backends.backend_agg', 'matplotlib.colors')
+"""
+Modules the plugins import lazily, imported once before the workers are forked
+"""
+
+MESSAGE_LEVELS = {
+    '[+] ': 'success',
+    '[-] ': 'fail',
+    '[*] ': 'debug',
+}
+"""
+Echo prefixes and the message level they stand for
+"""
+
+UNIX_PREFIX = 'unix:'
+"""
+Prefix of a Unix socket address
+"""
+
+def parse_messages(output: str):
+    """
+    Split captured console output into messages
+
+    Param:
+        output - output of success_echo, fail_echo and debug_echo
+
+    Returns:
+        A list of {'level': ..., 'message': ...}, lines without prefix continue the previous message
+    """
+    messages = []
+    for line in output.splitlines():
+        level = MESSAGE_LEVELS.get(line[:4])
+        if level is not None:
+            messages.append(dict(level=level, message=line[4:]))
+        elif messages:
+            messages[-1]['message'] += '\n' + line
+        else:
+            messages.append(dict(level='normal', message=line))
+    return messages
+
+def warm_up():
+    """
+    Import the modules the plugins only import when drawing
+    """
+    for name in WARM_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+class JobRunner:
+    """
+    Runs jobs in a pool of warm worker processes.
+
+    `build` turns a request into the argument of `func` (raising ValueError
+    for invalid requests), `func` runs it and returns (file path, captured
+    output, whether it succeeded, profile or None).
+    """
+
+    def __init__(self, func: Callable, build: Callable[[dict], object], jobs: int):
+        self.func = func
+        self.build = build
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(max_workers=jobs)
+        # Start the workers now, before the server threads exist
+        self.executor.submit(int).result()
+
+    def restart(self, executor: ProcessPoolExecutor):
+        """
+        Replace a broken pool, unless another thread already did
+
+        Param:
+            executor - the pool that broke
+        """
+        with self.lock:
+            if self.executor is executor:
+                executor.shutdown(wait=False)
+                self.executor = ProcessPoolExecutor(max_workers=self.jobs)
+
+    def submit(self, job):
+        """
+        Submit a job, restarting the pool once if it is broken
+
+        Returns:
+            (pool, future)
+        """
+        executor = self.executor
+        try:
+            return executor, executor.submit(self.func, job)
+        except BrokenProcessPool:
+            self.restart(executor)
+            executor = self.executor
+            return executor, executor.submit(self.func, job)
+
+    def run(self, requests: list[dict]):
+        """
+        Run jobs concurrently
+
+        Returns:
+            A result dict per request, in request order
+        """
+        futures = []
+        for request in requests:
+            try:
+                futures.append(self.submit(self.build(request)))
+            except (ValueError, TypeError, KeyError) as e:
+                futures.append(e)
+        return [self.result(request, future) for request, future in zip(requests, futures)]
+
+    def result(self, request: dict, future):
+        if isinstance(future, Exception):
+            return dict(error=str(future))
+        executor, future = future
+        try:
+            filepath, output, succeeded, profile = future.result()
+        except BrokenProcessPool as e:
+            # Later jobs get a fresh pool instead of failing until the server restarts
+            self.restart(executor)
+            return dict(error=f'Worker died: {e}')
+        result = dict(file=filepath, plugin=request.get('plugin'), succeeded=succeeded,
+                      output=output, messages=parse_messages(output))
+        if profile is not None:
+            result['profile'] = profile
+        return result
+
+    def handle(self, payload):
+        """
+        Run a job or a list of jobs
+
+        Returns:
+            A result, or a list of results for a list of jobs
+        """
+        if isinstance(payload, list):
+            return self.run(payload)
+        return self.run([payload])[0]
+
+    def close(self):
+        self.executor.shutdown()
+
+def http_handler(runner: JobRunner, plugins: list[str]):
+    class JobHandler(http.server.BaseHTTPRequestHandler):
+        def send_json(self, status: int, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/plugins':
+                self.send_json(200, dict(plugins=plugins))
+            elif self.path == '/health':
+                self.send_json(200, dict(status='ok'))
+            else:
+                self.send_json(404, dict(error=f'Unknown path: {self.path}'))
+
+        def do_POST(self):
+            if self.path != '/jobs':
+                self.send_json(404, dict(error=f'Unknown path: {self.path}'))
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError as e:
+                self.send_json(400, dict(error=f'Invalid JSON: {e}'))
+                return
+            self.send_json(200, runner.handle(payload))
+
+        def log_message(self, format, *args):
+            pass
+    return JobHandler
+
+def unix_handler(runner: JobRunner):
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    result = runner.handle(json.loads(line))
+                except ValueError as e:
+                    result = dict(error=f'Invalid JSON: {e}')
+                self.wfile.write(json.dumps(result).encode() + b'\n')
+                self.wfile.flush()
+    return JobHandler
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(address: str, runner: JobRunner, plugins: list[str]):
+    """
+    Create the server for an address
+
+    Param:
+        address - `unix:/path/to/socket`, `host:port` or `port` (HTTP)
+
+        runner - job runner
+
+        plugins - available plugin names
+
+    Returns:
+        A socketserver ready to `serve_forever`
+    """
+    if address.startswith(UNIX_PREFIX):
+        path = address[len(UNIX_PREFIX):]
+        if os.path.exists(path):
+            # Only a stale socket may be replaced, never a regular file
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise ValueError(f'{path} exists and is not a socket')
+            os.remove(path)
+        return ThreadingUnixServer(path, unix_handler(runner))
+    host, _, port = address.rpartition(':')
+    return http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), http_handler(runner, plugins))
+
+def serve(address: str, runner: JobRunner, plugins: list[str], ready: Callable[[str], None] = None):
+    """
+    Serve jobs until interrupted
+
+    Param:
+        address - see make_server
+
+        runner - job runner
+
+        plugins - available plugin names
+
+        ready - called with the address once the server listens
+
+    Raises:
+        ValueError, OSError - the address can not be served
+    """
+    try:
+        server = make_server(address, runner, plugins)
+    except (ValueError, OSError):
+        runner.close()
+        raise
+    if ready is not None:
+        ready(address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        runner.close()
+        if address.startswith(UNIX_PREFIX) and os.path.exists(address[len(UNIX_PREFIX):]):
+            os.remove(address[len(UNIX_PREFIX):])
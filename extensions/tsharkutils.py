@@ -1,6 +1,18 @@
-from . import call_outer, debug_echo
+from . import call_outer, iter_outer, debug_echo
+from .utils import ReportBuffer
+from .pcaputils import UsbReport, USB_TRANSFER_INTERRUPT
 import json
 
+CAPTURE_FILTER_PARAMS = ('usbhid.data', 'usb.capdata', )
+"""
+Fields holding USB payloads that need to be captured
+"""
+
+TSHARK_HEX_CHUNK_SIZE = 4096
+"""
+Packets whose hexadecimal payloads are decoded at once
+"""
+
 def get_layers(filepath: str, filter: str = '', debug: bool = False):
     ### DEBUG
     if debug:
@@ -13,4 +25,73 @@ def get_layers(filepath: str, filter: str = '', debug: bool = False):
     # Get layer packets
     layers = [pkt['_source']['layers'] for pkt in pcap]
     
-    return layers
\ No newline at end of file
+    return layers
+
+def iter_fields(filepath: str, fields: list[str], filter: str = '', debug: bool = False):
+    """
+    Stream the requested fields of every packet through `tshark -T fields`
+
+    Param:
+        filepath - capture file path
+
+        fields - field names, such as ['usb.src', 'usbhid.data']
+
+        filter - display filter
+
+        debug - Whether to output debugging information, False is default
+
+    Returns:
+        A generator of field value tuples, missing fields are empty strings
+    """
+    ### DEBUG
+    if debug:
+        debug_echo(f'Parsed file path: {filepath}')
+
+    cmd = ['tshark', '-r', filepath, '-T', 'fields', '-E', 'separator=/t', '-E', 'occurrence=f', '-Y', filter]
+    for field in fields:
+        cmd += ['-e', field]
+    for line in iter_outer(cmd):
+        values = line.split('\t')
+        if len(values) == len(fields):
+            yield tuple(values)
+
+def iter_usb_reports(filepath: str, filters: tuple[str] = CAPTURE_FILTER_PARAMS, debug: bool = False):
+    """
+    Generate USB reports of a capture through a single tshark run,
+    the payloads of every chunk of packets are decoded at once
+
+    Param:
+        filepath - capture file path
+
+        filters - the fields holding the payload, the first non-empty one is used
+
+        debug - Whether to output debugging information, False is default
+
+    Returns:
+        A generator of UsbReport
+    """
+    fields = ['frame.time_epoch', 'usb.src', *filters]
+    timestamps, device_ids, hex_strs = [], [], []
+    # HID reports only travel in interrupt transfers, like in the native reader
+    display_filter = f'({" || ".join(filters)}) && usb.transfer_type == {USB_TRANSFER_INTERRUPT:#04x}'
+    for i, (timestamp, device_id, *payloads) in enumerate(iter_fields(filepath, fields, display_filter, debug), 1):
+        timestamps.append(float(timestamp))
+        device_ids.append(device_id)
+        hex_strs.append(next((payload for payload in payloads if payload), ''))
+        if i % TSHARK_HEX_CHUNK_SIZE == 0:
+            yield from iter_buffer_reports(ReportBuffer.from_hex(timestamps, device_ids, hex_strs))
+            timestamps, device_ids, hex_strs = [], [], []
+    yield from iter_buffer_reports(ReportBuffer.from_hex(timestamps, device_ids, hex_strs))
+
+def iter_buffer_reports(buffer: ReportBuffer):
+    """
+    Generate the reports of a ReportBuffer, payloads are memoryviews of its buffer
+
+    Param:
+        buffer - packed reports
+
+    Returns:
+        A generator of UsbReport
+    """
+    for timestamp, device, data in zip(buffer.timestamps, buffer.devices, buffer):
+        yield UsbReport(timestamp, buffer.device_ids[device], data)
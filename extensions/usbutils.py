@@ -0,0 +1,299 @@
+from . import debug_echo, parallel_map
+from .pcaputils import UsbCaptureReader, UnsupportedCapture, UsbReport, shard_capture
+from .tsharkutils import iter_usb_reports
+from .cacheutils import ReportCache
+from .utils import ReportBuffer
+from .profileutils import stage, stage_iter
+from typing import Iterable, Optional
+import click
+import os
+import numpy as np
+
+SHARD_MIN_SIZE = 32 * 1024 * 1024
+"""
+Minimum size (bytes) of a shard when a capture is extracted by several processes
+"""
+
+KEYBOARD_KIND = 'keyboard'
+"""
+Report kind of boot keyboards, decoded by the keyboard plugin
+"""
+
+MICE_KIND = 'mice'
+"""
+Report kind of mice, decoded by the mice plugin
+"""
+
+REPORT_KIND_THRESHOLD = 0.9
+"""
+Share of a device's non-empty reports that must fit a kind for the device to be routed to it alone
+"""
+
+KEYBOARD_MAX_KEY_CODE = 0x65
+"""
+Highest key code of the keyboard/keypad usage page a typed report holds
+"""
+
+def group_reports_by_device(reports: Iterable[UsbReport]):
+    """
+    Group USB report payloads by the device they come from
+
+    Param:
+        reports - USB reports
+
+    Returns:
+        A dict mapping device id to a ReportBuffer of its hid-datas, all sharing one payload buffer
+    """
+    data = bytearray()
+    hiddata_mapping = {}
+    for report in reports:
+        hiddatas = hiddata_mapping.get(report.device_id)
+        if hiddatas is None:
+            hiddatas = hiddata_mapping[report.device_id] = ReportBuffer([report.device_id], data)
+        hiddatas.append(*report)
+    return hiddata_mapping
+
+def device_kind(hiddatas: ReportBuffer):
+    """
+    Guess whether a device is a keyboard or a mouse from the length and contents of its reports
+
+    A boot keyboard report has a zero reserved byte and its key slots hold
+    key codes packed to the front, a mouse report has the buttons in the
+    first byte, movements next and nothing after them. Single-key keyboard
+    reports fit both, so keyboards win when a device fits both kinds.
+
+    Param:
+        hiddatas - hid-datas of the device
+
+    Returns:
+        KEYBOARD_KIND, MICE_KIND, or None when the reports fit neither
+    """
+    lengths = hiddatas.column('lengths')
+    reports = hiddatas.matrix(8, np.flatnonzero(lengths == 8))
+    reports = reports[reports.any(axis=1)]
+    short_reports = np.count_nonzero(hiddatas.matrix(4, np.flatnonzero(lengths == 4)).any(axis=1))
+    total = len(reports) + short_reports
+    if total == 0:
+        return None
+    slots = reports[:, 2:]
+    valid = ((slots == 0) | ((slots >= 4) & (slots <= KEYBOARD_MAX_KEY_CODE))).all(axis=1)
+    packed = (np.diff((slots != 0).astype(np.int8), axis=1) <= 0).all(axis=1)
+    keyboard = np.count_nonzero((reports[:, 1] == 0) & valid & packed)
+    mice = np.count_nonzero((reports[:, 0] <= 0x07) & ~reports[:, 4:].any(axis=1)) + short_reports
+    if keyboard >= REPORT_KIND_THRESHOLD * total:
+        return KEYBOARD_KIND
+    if mice >= REPORT_KIND_THRESHOLD * total:
+        return MICE_KIND
+    return None
+
+def route_hiddata_mapping(hiddata_mapping: dict[str, ReportBuffer], kinds: Iterable[str]):
+    """
+    Split the devices of a capture between the decoders of several report kinds
+
+    Param:
+        hiddata_mapping - hid-datas grouped by device
+
+        kinds - report kinds being decoded
+
+    Returns:
+        A dict mapping each kind to the hid-datas of its devices, devices of no known kind go to every kind
+    """
+    routes = {kind: {} for kind in kinds}
+    for device_id, hiddatas in hiddata_mapping.items():
+        kind = device_kind(hiddatas)
+        for target in ([kind] if kind in routes else routes):
+            routes[target][device_id] = hiddatas
+    return routes
+
+def read_shard(job: tuple[str, Optional[dict], int]):
+    """
+    Read one packet range of a capture, used by the extraction workers
+
+    Param:
+        job - (capture file path, reader state, end offset)
+
+    Returns:
+        (report columns, offset of the last pcapng header block read, reader state at the end)
+    """
+    filepath, state, end = job
+    reader = UsbCaptureReader(filepath, state=state, end=end)
+    # Columns of plain values pickle faster than the report tuples
+    columns = tuple(map(list, zip(*reader))) or ([], [], [])
+    return columns, reader.header_offset, reader.state()
+
+def iter_sharded_reports(filepath: str, ranges: list[tuple[Optional[dict], int]], header_end: int,
+                         jobs: int, debug: bool = False):
+    """
+    Read the packet ranges of a capture in parallel, yielding the reports in capture order
+
+    Param:
+        filepath - capture file path
+
+        ranges - (reader state, end offset) of every shard, see shard_capture
+
+        header_end - end of the leading pcapng header blocks
+
+        jobs - number of worker processes
+
+        debug - Whether to output debugging information, False is default
+
+    Returns:
+        A generator of UsbReport
+    """
+    for columns, header_offset, state in parallel_map(read_shard, [(filepath, state, end) for state, end in ranges], jobs):
+        yield from map(UsbReport, *columns)
+        if header_offset >= header_end:
+            # A new section or interface makes the following shards start with stale interfaces
+            ### DEBUG
+            if debug:
+                debug_echo(f'pcapng header block at offset {header_offset}, reading the rest serially')
+            yield from UsbCaptureReader(filepath, debug, state)
+            return
+
+def extract_usb_reports(filepath: str, debug: bool = False, jobs: int = 1):
+    """
+    Extract USB reports of a capture.
+
+    The built-in pcap/pcapng reader is used first, tshark is only called
+    for the captures it can not handle. With several jobs, large captures
+    are split into packet ranges read by separate processes.
+
+    Param:
+        filepath - capture file path
+
+        debug - Whether to output debugging information, False is default
+
+        jobs - number of worker processes
+
+    Returns:
+        A generator of UsbReport
+    """
+    shards = min(jobs, os.path.getsize(filepath) // SHARD_MIN_SIZE)
+    ranges = []
+    if shards > 1:
+        try:
+            ranges, header_end = shard_capture(filepath, shards)
+        except UnsupportedCapture:
+            ranges = []
+    count = 0
+    try:
+        if len(ranges) > 1:
+            ### DEBUG
+            if debug:
+                debug_echo(f'Reading {len(ranges)} shards in parallel')
+            reports = stage_iter('sharded reader', iter_sharded_reports(filepath, ranges, header_end, jobs, debug))
+        else:
+            reports = stage_iter('native reader', UsbCaptureReader(filepath, debug))
+        for report in reports:
+            count += 1
+            yield report
+        return
+    except UnsupportedCapture as e:
+        # Reports already handed out can not be taken back, such as a pcapng adding a non-USB interface later on
+        if count:
+            raise click.ClickException(f'{e} after {count} USB reports of {filepath}, the capture can not be read') from None
+        ### DEBUG
+        if debug:
+            debug_echo(f'{e}, fall back to tshark')
+    yield from stage_iter('tshark', iter_usb_reports(filepath, debug=debug))
+
+def get_usb_reports(filepath: str, debug: bool = False, cache: Optional[ReportCache] = None, jobs: int = 1):
+    """
+    Get USB reports of a capture, from the cache if possible
+
+    Param:
+        filepath - capture file path
+
+        debug - Whether to output debugging information, False is default
+
+        cache - report cache of the capture, None to disable caching
+
+        jobs - number of extraction processes
+
+    Returns:
+        A generator of UsbReport
+    """
+    if cache is None:
+        return extract_usb_reports(filepath, debug, jobs)
+    reports = cache.load()
+    if reports is not None:
+        ### DEBUG
+        if debug:
+            debug_echo(f'Cache hit: {cache.path}')
+        return stage_iter('cache', reports)
+    return cache.store(extract_usb_reports(filepath, debug, jobs))
+
+def get_hiddata_mapping(filepath: str, debug: bool = False, cache: Optional[ReportCache] = None, jobs: int = 1):
+    """
+    Extract hid-datas of a capture grouped by device
+
+    Param:
+        filepath - capture file path
+
+        debug - Whether to output debugging information, False is default
+
+        cache - report cache of the capture, None to disable caching
+
+        jobs - number of extraction processes
+
+    Returns:
+        A dict mapping device id to a ReportBuffer of its hid-datas
+    """
+    with stage('extraction') as recorder:
+        buffer = cache.load_buffer() if cache is not None else None
+        if buffer is None:
+            hiddata_mapping = group_reports_by_device(get_usb_reports(filepath, debug, cache, jobs))
+        else:
+            ### DEBUG
+            if debug:
+                debug_echo(f'Cache hit: {cache.path}')
+            hiddata_mapping = buffer.by_device()
+        recorder.add(sum(map(len, hiddata_mapping.values())))
+    return hiddata_mapping
+
+def get_plugin_hiddata_mapping(obj: dict, kind: str, debug: bool = False, jobs: int = 1):
+    """
+    Hid-datas a plugin decodes: the devices routed to its report kind when
+    several plugins share one extraction, otherwise every device of the capture
+
+    Param:
+        obj - context object, holding `routed_hiddata` when plugins are chained
+
+        kind - report kind of the plugin
+
+        debug - Whether to output debugging information, False is default
+
+        jobs - number of extraction processes
+
+    Returns:
+        A dict mapping device id to a ReportBuffer of its hid-datas
+    """
+    routed = obj.get('routed_hiddata')
+    if routed is not None and kind in routed:
+        return routed[kind]
+    return get_hiddata_mapping(obj['filepath'], debug, obj['cache'], jobs)
+
+def get_new_hiddata_mapping(filepath: str, state: Optional[dict] = None, debug: bool = False):
+    """
+    Extract the hid-datas appended to a capture since a previous extraction.
+
+    Only the built-in reader can resume, so tshark is never used.
+
+    Param:
+        filepath - capture file path
+
+        state - reader state returned by the previous extraction, None to start from the beginning
+
+        debug - Whether to output debugging information, False is default
+
+    Returns:
+        (hiddata_mapping, state) hid-datas grouped by device and the reader state to resume from next time
+
+    Raises:
+        UnsupportedCapture - the built-in reader can not read the capture
+    """
+    reader = UsbCaptureReader(filepath, debug, state)
+    with stage('extraction') as recorder:
+        hiddata_mapping = group_reports_by_device(stage_iter('native reader', reader))
+        recorder.add(sum(map(len, hiddata_mapping.values())))
+    return hiddata_mapping, reader.state()
@@ -1,3 +1,23 @@
+import hashlib
+import os
+from array import array
+from typing import Callable, Iterable, Optional, Sequence
+
+HASH_CHUNK_SIZE = 1024 * 1024
+"""
+Read size (bytes) when hashing a file
+"""
+
+FINGERPRINT_SAMPLES = 16
+"""
+Number of blocks sampled by a fast fingerprint
+"""
+
+REPORT_COLUMNS = {'offsets': 'q', 'lengths': 'I', 'devices': 'I', 'timestamps': 'd'}
+"""
+Typecode of every index column of a ReportBuffer
+"""
+
 def unhexlify(hex_str: str):
     """
     Turn `00:00:00:00` to `b'\\x00\\x00\\x00\\x00'`
@@ -20,4 +40,249 @@ def hexlify(bytes_array: bytes):
     Returns:
         Hexadecimal strings
     """
-    return ':'.join(f'{i:02x}' for i in bytes_array)
\ No newline at end of file
+    return ':'.join(f'{i:02x}' for i in bytes_array)
+
+def file_sha1(filepath: str):
+    """
+    SHA1 of a file, read chunk by chunk
+
+    Param:
+        filepath - file path
+
+    Returns:
+        Hexadecimal digest
+    """
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def file_fingerprint(filepath: str):
+    """
+    Cheap fingerprint of a file made of its size, mtime and a few sampled blocks
+
+    Param:
+        filepath - file path
+
+    Returns:
+        Hexadecimal digest
+    """
+    stat = os.stat(filepath)
+    sha1 = hashlib.sha1(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    block_size = HASH_CHUNK_SIZE // FINGERPRINT_SAMPLES
+    with open(filepath, 'rb') as f:
+        # Evenly spaced blocks, always including the first and the last one
+        for i in range(FINGERPRINT_SAMPLES):
+            f.seek(max(stat.st_size - block_size, 0) * i // (FINGERPRINT_SAMPLES - 1))
+            sha1.update(f.read(block_size))
+    return sha1.hexdigest()
+
+class LazyDict(dict):
+    """
+    A dict whose values can be computed on first access.
+
+    Only `d[key]` triggers the computation, `key in d` and `d.get(key)` see
+    the value only once it has been computed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.factories: dict[str, Callable] = {}
+
+    def lazy(self, key: str, factory: Callable):
+        """
+        Register a value computed on first access
+
+        Param:
+            key - dict key
+
+            factory - function called with this dict that returns the value
+        """
+        self.factories[key] = factory
+
+    def __missing__(self, key):
+        if key not in self.factories:
+            raise KeyError(key)
+        self[key] = value = self.factories.pop(key)(self)
+        return value
+
+class ReportBuffer:
+    """
+    USB reports stored column by column: the payloads packed in one
+    contiguous buffer, with offset, length, device and timestamp columns.
+
+    Every column supports the buffer protocol, so `column()` and `matrix()`
+    give NumPy views without copying, and `buffer[i]` is a memoryview of one
+    payload. Buffers split by `by_device()` share the payload buffer of
+    the whole capture; they are compacted when pickled. Only buffers built
+    by `append` can grow, and not while a view of their payloads is alive.
+    """
+
+    def __init__(self, device_ids: Sequence[str] = (), data=None, **columns):
+        self.device_ids = list(device_ids)
+        self.device_index = {device_id: i for i, device_id in enumerate(self.device_ids)}
+        self.data = bytearray() if data is None else data
+        for name, typecode in REPORT_COLUMNS.items():
+            setattr(self, name, columns.get(name, array(typecode)))
+
+    @classmethod
+    def from_hex(cls, timestamps: Iterable[float], device_ids: Iterable[str], hex_strs: Sequence[str]):
+        """
+        Pack reports whose payloads are hexadecimal strings, all of them decoded at once
+
+        Param:
+            timestamps - timestamp of every report
+
+            device_ids - device id of every report
+
+            hex_strs - payload of every report, such as `00:01:02` or `000102`
+
+        Returns:
+            ReportBuffer
+        """
+        buffer = cls(data=bytearray.fromhex(''.join(hex_strs).replace(':', '')))
+        buffer.timestamps.extend(timestamps)
+        buffer.devices.extend(buffer.device_index.setdefault(device_id, len(buffer.device_index)) for device_id in device_ids)
+        buffer.device_ids = list(buffer.device_index)
+        offset = 0
+        for hex_str in hex_strs:
+            length = (len(hex_str) - hex_str.count(':')) // 2
+            buffer.offsets.append(offset)
+            buffer.lengths.append(length)
+            offset += length
+        return buffer
+
+    def append(self, timestamp: float, device_id: str, data: bytes):
+        """
+        Copy one report to the end of the buffer
+        """
+        device = self.device_index.get(device_id)
+        if device is None:
+            device = self.device_index[device_id] = len(self.device_ids)
+            self.device_ids.append(device_id)
+        self.offsets.append(len(self.data))
+        self.lengths.append(len(data))
+        self.devices.append(device)
+        self.timestamps.append(timestamp)
+        self.data += data
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index: int):
+        offset = self.offsets[index]
+        return memoryview(self.data)[offset:offset + self.lengths[index]]
+
+    def __iter__(self):
+        data = memoryview(self.data)
+        for offset, length in zip(self.offsets, self.lengths):
+            yield data[offset:offset + length]
+
+    def __reduce__(self):
+        buffer = self.compact()
+        return (ReportBuffer, (buffer.device_ids, buffer.data), {name: getattr(buffer, name) for name in REPORT_COLUMNS})
+
+    def column(self, name: str):
+        """
+        NumPy view of an index column
+
+        Param:
+            name - offsets, lengths, devices or timestamps
+
+        Returns:
+            1-D array sharing the memory of the column
+        """
+        import numpy as np
+        return np.frombuffer(getattr(self, name), dtype=REPORT_COLUMNS[name])
+
+    def matrix(self, width: int, rows: Optional[Sequence[int]] = None):
+        """
+        Payloads as an N x width uint8 array, truncated or padded with zeros
+
+        When every payload has this width and they lie back to back, the
+        array is a view of the payload buffer.
+
+        Param:
+            width - bytes kept from every payload
+
+            rows - indices of the reports to stack, None for all of them
+
+        Returns:
+            uint8 array
+        """
+        import numpy as np
+        data = np.frombuffer(self.data, dtype=np.uint8)
+        offsets = self.column('offsets')
+        lengths = self.column('lengths')
+        if rows is not None:
+            offsets = offsets[rows]
+            lengths = lengths[rows]
+        full = lengths >= width
+        if len(offsets) and np.all(lengths == width) and np.all(np.diff(offsets) == width):
+            return data[offsets[0]:offsets[0] + len(offsets) * width].reshape(len(offsets), width)
+        matrix = np.zeros((len(offsets), width), dtype=np.uint8)
+        if width and np.any(full):
+            # Every window of `width` bytes, each report only copies its own
+            matrix[full] = np.lib.stride_tricks.sliding_window_view(data, width)[offsets[full]]
+        short = np.flatnonzero(~full)
+        if short.size:
+            columns = np.arange(width)
+            present = columns < lengths[short, None]
+            padded = np.zeros((short.size, width), dtype=np.uint8)
+            padded[present] = data[(offsets[short, None] + columns)[present]]
+            matrix[short] = padded
+        return matrix
+
+    def select(self, rows: Sequence[int]):
+        """
+        Reports at the given indices, sharing the payload buffer
+
+        Param:
+            rows - report indices
+
+        Returns:
+            ReportBuffer
+        """
+        return ReportBuffer(self.device_ids, self.data, **{name: self.column(name)[rows] for name in REPORT_COLUMNS})
+
+    def by_device(self):
+        """
+        Split the reports by device, keeping their order
+
+        Returns:
+            A dict mapping device id to a ReportBuffer of its reports, in order of first appearance
+        """
+        if len(self.device_ids) == 1:
+            return {self.device_ids[0]: self}
+        import numpy as np
+        devices = self.column('devices')
+        order = np.argsort(devices, kind='stable')
+        bounds = np.searchsorted(devices[order], np.arange(len(self.device_ids) + 1))
+        mapping = {}
+        for device, device_id in enumerate(self.device_ids):
+            buffer = self.select(order[bounds[device]:bounds[device + 1]])
+            buffer.devices[:] = 0
+            buffer.device_ids = [device_id]
+            buffer.device_index = {device_id: 0}
+            mapping[device_id] = buffer
+        return mapping
+
+    def compact(self):
+        """
+        Copy of the reports whose payload buffer only holds them, back to back
+
+        Returns:
+            ReportBuffer, this one if it is already compact
+        """
+        import numpy as np
+        lengths = self.column('lengths')
+        offsets = self.column('offsets')
+        total = int(lengths.sum())
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(REPORT_COLUMNS['offsets'])
+        if total == len(self.data) and np.array_equal(offsets, starts):
+            return self
+        index = np.repeat(offsets - starts, lengths) + np.arange(total)
+        data = bytearray(np.frombuffer(self.data, dtype=np.uint8)[index].tobytes())
+        return ReportBuffer(self.device_ids, data, offsets=starts, lengths=lengths.copy(),
+                            devices=self.column('devices').copy(), timestamps=self.column('timestamps').copy())
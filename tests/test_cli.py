@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'dataextractor.py')
+MICE_CAPTURE = os.path.join(ROOT, 'mice_test', 'data.pcap')
+
+def run_cli(tmp_path, *args):
+    env = dict(os.environ, TEMP=str(tmp_path))
+    return subprocess.run([sys.executable, SCRIPT, *args], cwd=tmp_path, env=env, capture_output=True, text=True)
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_chained_usage_error(tmp_path, jobs):
+    result = run_cli(tmp_path, '-f', MICE_CAPTURE, '-j', jobs, 'keyboard', '-s', '-i', 'mice', '-t')
+    assert result.returncode == 2
+    assert 'Traceback' not in result.stderr
+    assert "Usage: dataextractor.py keyboard" in result.stderr
+    assert "can not be combined with '-i' / '--incremental'" in result.stderr
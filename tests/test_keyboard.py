@@ -0,0 +1,17 @@
+from extensions.keyboard import stream_parse
+from extensions.pcaputils import UsbReport
+
+def make_reports():
+    # Device 1.1.1 types "ab", device 1.2.1 only sends released reports
+    pressed = [b'\x00\x00\x04\x00\x00\x00\x00\x00', b'\x00' * 8, b'\x00\x00\x05\x00\x00\x00\x00\x00', b'\x00' * 8]
+    reports = [UsbReport(float(i), '1.1.1', data) for i, data in enumerate(pressed)]
+    reports += [UsbReport(float(i), '1.2.1', b'\x00' * 8) for i in range(4)]
+    return reports
+
+def test_stream_echoes_every_device(capsys):
+    stream_parse(make_reports(), None, None)
+    output = capsys.readouterr().out
+    assert 'Device ID: 1.1.1' in output
+    assert 'Raw: ab' in output
+    assert 'Device ID: 1.2.1' in output
+    assert output.count('Raw: ') == 2
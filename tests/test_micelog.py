@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import pytest
+from extensions.micelog import MicelogFollower, micemsg_from_micelog, micemsg_from_micelog_file, FOLLOW_READ_SIZE
+
+SAMPLE_MICELOG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'micelog_test', 'micelog')
+
+def make_micelog(count: int, packet_size: int = 3, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    x = rng.integers(-5, 6, count)
+    y = rng.integers(-5, 6, count)
+    flags = 0x08 | (x < 0) << 4 | (y < 0) << 5 | rng.integers(0, 2, count)
+    packets = np.zeros((count, packet_size), np.uint8)
+    packets[:, 0] = flags
+    packets[:, 1] = x & 0xff
+    packets[:, 2] = y & 0xff
+    return packets.tobytes()
+
+def follow(data: bytes, read_size: int = FOLLOW_READ_SIZE):
+    follower = MicelogFollower()
+    for start in range(0, len(data), read_size):
+        follower.feed(data[start:start + read_size])
+    return follower.trajectory
+
+def assert_same_trajectory(left, right):
+    assert len(left) == len(right)
+    np.testing.assert_array_equal(left.status, right.status)
+    np.testing.assert_array_equal(left.x, right.x)
+    np.testing.assert_array_equal(left.y, right.y)
+
+@pytest.mark.parametrize('packet_size', [3, 4])
+@pytest.mark.parametrize('read_size', [FOLLOW_READ_SIZE, 1000])
+def test_follow_matches_file(tmp_path, packet_size, read_size):
+    data = make_micelog(30000, packet_size)
+    path = tmp_path / 'micelog'
+    path.write_bytes(data)
+    trajectory = follow(data, read_size)
+    assert len(trajectory) == 30001
+    assert_same_trajectory(trajectory, micemsg_from_micelog_file(str(path)))
+
+def test_follow_matches_sample():
+    with open(SAMPLE_MICELOG, 'rb') as f:
+        data = f.read()
+    assert_same_trajectory(follow(data), micemsg_from_micelog_file(SAMPLE_MICELOG))
+
+@pytest.mark.parametrize('packet_size', [3, 4])
+def test_leading_packets_at_another_phase(capsys, packet_size):
+    # A few packets, then the tail of a packet shifting the rest of the log to another phase
+    leading = make_micelog(20, packet_size, seed=1)
+    rest = make_micelog(2000, packet_size)
+    partial = make_micelog(1, packet_size, seed=2)[1:]
+    trajectory = micemsg_from_micelog(leading + partial + rest)
+    assert_same_trajectory(trajectory, micemsg_from_micelog(leading + rest))
+    # Only the partial packet is skipped
+    output = capsys.readouterr().out
+    assert output.count('Skipped corrupted data') == 1
+    assert f'Skipped corrupted data from offset {len(leading)} to {len(leading) + len(partial)}' in output
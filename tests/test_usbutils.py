@@ -0,0 +1,22 @@
+import os
+import struct
+import click
+import pytest
+from extensions.usbutils import extract_usb_reports
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KEYBOARD_CAPTURE = os.path.join(ROOT, 'keyboard_test', 'usb.pcapng')
+
+LINKTYPE_ETHERNET = 1
+
+def test_unsupported_interface_after_reports(tmp_path):
+    # A pcapng declaring an Ethernet interface after its USB packets
+    idb = struct.pack('<IIHHII', 1, 20, LINKTYPE_ETHERNET, 0, 0xffff, 20)
+    path = tmp_path / 'mixed.pcapng'
+    with open(KEYBOARD_CAPTURE, 'rb') as f:
+        path.write_bytes(f.read() + idb)
+    with pytest.raises(click.ClickException, match='Unsupported link type: 1 after'):
+        list(extract_usb_reports(str(path)))
+
+def test_supported_capture():
+    assert any(True for _ in extract_usb_reports(KEYBOARD_CAPTURE))